@@ -58,7 +58,7 @@ async def on_error(context: TurnContext, error: Exception):
 ADAPTER.on_turn_error = on_error
 
 # Create the Bot
-BOT = MyBot()
+BOT = MyBot(CONFIG)
 
 
 # Listen for incoming requests on /api/messages
@@ -78,8 +78,16 @@ async def messages(req: Request) -> Response:
     return Response(status=201)
 
 
+# Worker pool gauges, used to size the instances
+async def metrics(req: Request) -> Response:
+    return json_response(data={"worker_pool": BOT.worker_pool.metrics()})
+
+
 APP = web.Application(middlewares=[aiohttp_error_middleware])
 APP.router.add_post("/api/messages", messages)
+APP.router.add_get("/api/metrics", metrics)
+APP.on_startup.append(BOT.on_startup)
+APP.on_shutdown.append(BOT.on_shutdown)
 
 if __name__ == "__main__":
     try:
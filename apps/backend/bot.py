@@ -6,7 +6,9 @@ import asyncio
 import random
 import requests
 import json
-from concurrent.futures import ThreadPoolExecutor
+import time
+import threading
+from collections import deque
 from langchain.chat_models import AzureChatOpenAI
 from langchain.utilities import BingSearchAPIWrapper
 from langchain.memory import ConversationBufferWindowMemory
@@ -14,12 +16,11 @@ from langchain.memory import CosmosDBChatMessageHistory
 from langchain.agents import ConversationalChatAgent, AgentExecutor, Tool
 from typing import Any, Dict, List, Optional, Union
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain.callbacks.manager import CallbackManager
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
 #custom libraries that we will use later in the app
-from utils import DocSearchAgent, CSVTabularAgent, SQLSearchAgent, ChatGPTTool, BingSearchAgent, APISearchAgent, run_agent, reduce_openapi_spec
-from prompts import WELCOME_MESSAGE, CUSTOM_CHATBOT_PREFIX, CUSTOM_CHATBOT_SUFFIX
+from utils import DocSearchAgent, CSVTabularAgent, SQLSearchAgent, ChatGPTTool, BingSearchAgent, APISearchAgent, arun_agent, get_search_client, reduce_openapi_spec, WindowedChatHistoryStore, CosmosDBMessageStore, get_sql_schema_index
+from prompts import WELCOME_MESSAGE, BUSY_MESSAGE, CUSTOM_CHATBOT_PREFIX, CUSTOM_CHATBOT_SUFFIX
 
 from botbuilder.core import ActivityHandler, TurnContext
 from botbuilder.schema import ChannelAccount, Activity, ActivityTypes
@@ -30,29 +31,377 @@ os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
 
 # Callback hanlder used for the bot service to inform the client of the thought process before the final response
 class BotServiceCallbackHandler(BaseCallbackHandler):
-    """Callback handler to use in Bot Builder Application"""
+    """Callback handler to use in Bot Builder Application.
+    It can be called from any thread: status updates are scheduled on the bot event loop without waiting for them,
+    bursts are coalesced into at most one message (plus a typing indicator) every interval seconds,
+    and whatever is still pending when close() is called is dropped."""
     
-    def __init__(self, turn_context: TurnContext) -> None:
+    run_inline = True # Callbacks only queue the update, no need for a thread on the async path
+    
+    def __init__(self, turn_context: TurnContext, loop: Optional[asyncio.AbstractEventLoop] = None, interval: float = 1.0) -> None:
         self.tc = turn_context
+        self.loop = loop or asyncio.get_running_loop()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.typing = False
+        self.flush_scheduled = None
+        self.last_sent = 0
+        self.closed = False
+
+    def _post(self, text: str, typing: bool = False) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.append(text)
+            self.typing = self.typing or typing
+            if self.flush_scheduled is None:
+                self.flush_scheduled = asyncio.run_coroutine_threadsafe(self._flush(), self.loop)
+    
+    async def _flush(self) -> None:
+        delay = self.last_sent + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        with self.lock:
+            pending, typing = self.pending, self.typing
+            self.pending, self.typing = [], False
+            self.flush_scheduled = None
+            if self.closed or not pending:
+                return
+            self.last_sent = time.monotonic()
+        try:
+            await self.tc.send_activity("\n\n".join(pending))
+            if typing:
+                await self.tc.send_activity(Activity(type=ActivityTypes.typing))
+        except Exception as e:
+            print("Exception:",e)
+    
+    def close(self) -> None:
+        """Drop the progress not sent yet, called when the final answer is ready"""
+        with self.lock:
+            self.closed = True
+            self.pending = []
+            if self.flush_scheduled is not None:
+                self.flush_scheduled.cancel()
+                self.flush_scheduled = None
 
     def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
-        asyncio.run(self.tc.send_activity(f"LLM Error: {error}\n"))
+        self._post(f"LLM Error: {error}\n")
 
     def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
-        asyncio.run(self.tc.send_activity(f"Tool: {serialized['name']}"))
+        self._post(f"Tool: {serialized['name']}")
 
     def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
         if "Action Input" in action.log:
             action = action.log.split("Action Input:")[1]
-            asyncio.run(self.tc.send_activity(f"\u2611 Searching: {action} ..."))
-            asyncio.run(self.tc.send_activity(Activity(type=ActivityTypes.typing)))
+            self._post(f"\u2611 Searching: {action} ...", typing=True)
 
             
+# Final answers as written by the ReAct tool agents and by the conversational brain agent (inside a JSON blob)
+FINAL_ANSWER_TEXT = re.compile(r"Final Answer:\s*")
+FINAL_ANSWER_JSON = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+
+def decode_partial_json_string(text: str) -> str:
+    """Decodes the JSON string that starts at text, which may still be incomplete, up to its closing quote"""
+    chars = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            break
+        if c == "\\":
+            escape = text[i:i+6] if text[i+1:i+2] == "u" else text[i:i+2]
+            if len(escape) < (6 if text[i+1:i+2] == "u" else 2):
+                break # The rest of the escape sequence has not been streamed yet
+            try:
+                chars.append(json.loads('"' + escape + '"'))
+            except ValueError:
+                chars.append(escape)
+            i += len(escape)
+            continue
+        chars.append(c)
+        i += 1
+    return "".join(chars)
+
+
+class BotServiceStreamingCallbackHandler(BotServiceCallbackHandler):
+    """BotServiceCallbackHandler that also streams the final answer while the LLM writes it.
+    The answer is sent as one message that is updated at most once every interval seconds,
+    finish() replaces it with the complete answer. Only works with LLMs that have streaming enabled."""
+    
+    def __init__(self, turn_context: TurnContext, loop: Optional[asyncio.AbstractEventLoop] = None, interval: float = 1.0) -> None:
+        super().__init__(turn_context, loop=loop, interval=interval)
+        self.buffers = {}
+        self.answer = ""
+        self.answer_activity_id = None
+        self.stream_scheduled = None
+        self.stream_failed = False
+        self.send_lock = asyncio.Lock()
+    
+    def on_llm_new_token(self, token: str, *, run_id: Any = None, **kwargs: Any) -> None:
+        buffer = self.buffers.get(run_id, "") + token
+        self.buffers[run_id] = buffer
+        
+        match = FINAL_ANSWER_JSON.search(buffer)
+        if match:
+            answer = decode_partial_json_string(buffer[match.end():])
+        else:
+            match = FINAL_ANSWER_TEXT.search(buffer)
+            if not match:
+                return
+            answer = buffer[match.end():]
+        
+        with self.lock:
+            if self.closed or self.stream_failed or not answer.strip() or answer == self.answer:
+                return
+            self.answer = answer
+            # The answer is being written, any progress not sent yet is stale
+            self.pending = []
+            if self.stream_scheduled is None:
+                self.stream_scheduled = asyncio.run_coroutine_threadsafe(self._stream(), self.loop)
+    
+    def on_llm_end(self, response: LLMResult, *, run_id: Any = None, **kwargs: Any) -> None:
+        self.buffers.pop(run_id, None)
+    
+    async def _stream(self) -> None:
+        delay = self.last_sent + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self.send_lock:
+            with self.lock:
+                self.stream_scheduled = None
+                if self.closed:
+                    return
+                answer = self.answer
+                self.last_sent = time.monotonic()
+            await self._send_answer(answer)
+    
+    async def _send_answer(self, answer: str) -> None:
+        try:
+            if self.answer_activity_id is None:
+                response = await self.tc.send_activity(answer)
+                self.answer_activity_id = response.id if response else None
+                if self.answer_activity_id is None:
+                    self.stream_failed = True
+            else:
+                await self.tc.update_activity(Activity(id=self.answer_activity_id, type=ActivityTypes.message, text=answer))
+        except Exception as e:
+            # The channel does not support updating messages, the answer is sent once at the end
+            print("Exception:",e)
+            self.stream_failed = True
+    
+    def close(self) -> None:
+        super().close()
+        with self.lock:
+            if self.stream_scheduled is not None:
+                self.stream_scheduled.cancel()
+                self.stream_scheduled = None
+    
+    async def finish(self, answer: str) -> None:
+        """Sends the complete answer, as an update of the streamed message when there is one"""
+        self.close()
+        async with self.send_lock:
+            if self.answer_activity_id is not None and not self.stream_failed:
+                await self._send_answer(answer)
+                if not self.stream_failed:
+                    return
+            await self.tc.send_activity(answer)
+
+            
+# Everything that does not change between messages is built once per process
+class BotResources:
+    """LLMs, tools, brain agent and chat history store shared by all the conversations.
+    The OpenAPI spec used by the API tool is refreshed in the background every spec_refresh_seconds."""
+    
+    def __init__(self, model_name: str, spec_url: str = "https://disease.sh/apidocs/swagger_v3.json", spec_refresh_seconds: int = 3600,
+                 streaming: bool = False, memory_k: int = 30, history_max_sessions: int = 1000, history_flush_interval: float = 1.0):
+        self.spec_url = spec_url
+        self.spec_refresh_seconds = spec_refresh_seconds
+        
+        # Set LLMs, the callbacks of each turn are passed when running the agent
+        # This is the LLM that writes the final answers, the brain agent's ones and the tools' ones
+        self.llm = AzureChatOpenAI(deployment_name=model_name, temperature=0.5, max_tokens=1000, streaming=streaming)
+        self.llm_search = AzureChatOpenAI(deployment_name="gpt-35-turbo-16k", temperature=0, max_tokens=1000)
+
+        # Initialize our Tools/Experts
+        text_indexes = ["cogsrch-index-files", "cogsrch-index-csv"]
+        doc_search = DocSearchAgent(llm=self.llm, indexes=text_indexes,
+                           k=10, similarity_k=4, reranker_th=1,
+                           sas_token=os.environ['BLOB_SAS_TOKEN'],
+                           return_direct=True)
+        vector_only_indexes = ["cogsrch-index-books-vector"]
+        book_search = DocSearchAgent(llm=self.llm, vector_only_indexes = vector_only_indexes,
+                           k=10, similarity_k=10, reranker_th=1,
+                           sas_token=os.environ['BLOB_SAS_TOKEN'],
+                           return_direct=True,
+                           name="@booksearch",
+                           description="useful when the questions includes the term: @booksearch.\n")
+        www_search = BingSearchAgent(llm=self.llm, k=5, return_direct=True)
+        sql_search = SQLSearchAgent(llm=self.llm, k=10, return_direct=True)
+        chatgpt_search = ChatGPTTool(llm=self.llm, return_direct=True)
+        
+        try:
+            api_spec = self.load_api_spec()
+            self.api_spec_loaded = True
+        except Exception as e:
+            print("Could not load the OpenAPI spec:", e)
+            api_spec = ""
+            self.api_spec_loaded = False
+        api_search = self.build_api_search(api_spec)
+
+        self.tools = [www_search, sql_search, doc_search, chatgpt_search, book_search, api_search]
+        self.agent = ConversationalChatAgent.from_llm_and_tools(llm=self.llm, tools=self.tools,system_message=CUSTOM_CHATBOT_PREFIX,human_message=CUSTOM_CHATBOT_SUFFIX)
+
+        # Create the CosmosDB database and container if they do not exist
+        cosmos = CosmosDBChatMessageHistory(
+                        cosmos_endpoint=os.environ['AZURE_COSMOSDB_ENDPOINT'],
+                        cosmos_database=os.environ['AZURE_COSMOSDB_NAME'],
+                        cosmos_container=os.environ['AZURE_COSMOSDB_CONTAINER_NAME'],
+                        connection_string=os.environ['AZURE_COMOSDB_CONNECTION_STRING'],
+                        session_id="",
+                        user_id=""
+                    )
+        cosmos.prepare_cosmos()
+        
+        # Only the last memory_k turns of a session are read, new messages are written behind in batches
+        self.memory_k = memory_k
+        self.chat_history = WindowedChatHistoryStore(CosmosDBMessageStore(cosmos._container), window=2*memory_k,
+                                                     max_sessions=history_max_sessions, flush_interval=history_flush_interval)
+    
+    def warm_up(self):
+        """Reflects the SQL database and builds its schema index, so the first @sqlsearch question does not wait for them"""
+        try:
+            get_sql_schema_index()
+        except Exception as e:
+            print("Could not build the SQL schema index:", e)
+    
+    def load_api_spec(self) -> str:
+        spec = requests.get(self.spec_url, timeout=30).json()
+        return str(reduce_openapi_spec(spec))
+    
+    def build_api_search(self, api_spec: str) -> APISearchAgent:
+        return APISearchAgent(llm=self.llm,
+                            llm_search=self.llm_search,
+                            api_spec=api_spec, 
+                            limit_to_domains=["https://disease.sh/"],
+                            return_direct=True)
+    
+    async def refresh_api_spec(self, retry_seconds: float = 5):
+        """Reloads the OpenAPI spec forever, the tools list is swapped so running turns keep the old one.
+        Until a spec has been loaded, it is retried after retry_seconds, doubled on each failure up to spec_refresh_seconds"""
+        loop = asyncio.get_running_loop()
+        retry_delay = retry_seconds
+        while True:
+            if self.api_spec_loaded:
+                await asyncio.sleep(self.spec_refresh_seconds)
+            else:
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.spec_refresh_seconds)
+            try:
+                api_spec = await loop.run_in_executor(None, self.load_api_spec)
+            except Exception as e:
+                print("Could not refresh the OpenAPI spec:", e)
+                continue
+            self.api_spec_loaded = True
+            self.tools = [self.build_api_search(api_spec) if isinstance(tool, APISearchAgent) else tool for tool in self.tools]
+    
+    async def get_agent_chain(self, session_id: str, user_id: str) -> AgentExecutor:
+        """Returns an executor for one turn, with the memory of the session loaded off the event loop"""
+        await self.chat_history.aload(session_id=session_id, user_id=user_id)
+        chat_history = self.chat_history.get_history(session_id=session_id, user_id=user_id)
+        memory = ConversationBufferWindowMemory(memory_key="chat_history", return_messages=True, k=self.memory_k, chat_memory=chat_history)
+        return AgentExecutor.from_agent_and_tools(agent=self.agent, tools=self.tools, memory=memory, handle_parsing_errors=True)
+
+            
+class WorkerPoolBusy(Exception):
+    """Raised when the agent worker pool and its wait queue are full"""
+
+
+# Process-wide limit on the agent turns, so a burst of messages cannot run unbounded turns at once
+class AgentWorkerPool:
+    """Runs async agent turns on the event loop, max_concurrent_turns at a time (arun).
+    At most max_queue turns wait for a free slot, turns beyond that are rejected right away with WorkerPoolBusy."""
+    
+    def __init__(self, max_queue: int, max_concurrent_turns: int = 256):
+        self.max_queue = max_queue
+        self.max_concurrent_turns = max_concurrent_turns
+        self.semaphore = None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=1000)
+    
+    async def arun(self, coro_func, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_turns)
+        with self.lock:
+            if self.active + self.waiting >= self.max_concurrent_turns + self.max_queue:
+                self.rejected += 1
+                raise WorkerPoolBusy()
+            self.waiting += 1
+        queued_at = time.monotonic()
+        
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            with self.lock:
+                self.waiting -= 1
+            raise
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+            self.wait_times.append(time.monotonic() - queued_at)
+        try:
+            return await coro_func(*args)
+        finally:
+            self.semaphore.release()
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+    
+    def metrics(self) -> dict:
+        """Active turns, queue depth and queue wait time gauges, used to size the instances"""
+        with self.lock:
+            wait_times = sorted(self.wait_times)
+            return {
+                "max_queue": self.max_queue,
+                "max_concurrent_turns": self.max_concurrent_turns,
+                "active_turns": self.active,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_wait_ms_avg": 1000 * sum(wait_times) / len(wait_times) if wait_times else 0,
+                "queue_wait_ms_p95": 1000 * wait_times[int(0.95 * (len(wait_times) - 1))] if wait_times else 0,
+            }
+
+
 # Bot Class
 class MyBot(ActivityHandler):
     
-    def __init__(self):
+    def __init__(self, config):
         self.model_name = os.environ.get("AZURE_OPENAI_MODEL_NAME") 
+        self.status_update_interval = config.STATUS_UPDATE_INTERVAL
+        self.resources = BotResources(self.model_name,
+                                      spec_refresh_seconds=int(os.environ.get("API_SPEC_REFRESH_SECONDS", 3600)),
+                                      streaming=config.STREAMING,
+                                      history_max_sessions=config.CHAT_HISTORY_MAX_SESSIONS,
+                                      history_flush_interval=config.CHAT_HISTORY_FLUSH_INTERVAL)
+        self.streaming = config.STREAMING
+        self.streaming_channels = set(config.STREAMING_CHANNELS)
+        self.worker_pool = AgentWorkerPool(max_queue=config.AGENT_QUEUE_SIZE, max_concurrent_turns=config.AGENT_CONCURRENT_TURNS)
+    
+    # Start the background tasks, called by the aiohttp app on startup
+    async def on_startup(self, app):
+        app["api_spec_refresh"] = asyncio.create_task(self.resources.refresh_api_spec())
+        asyncio.get_running_loop().run_in_executor(None, self.resources.warm_up)
+    
+    # Stop the background tasks and close the pooled connections, called by the aiohttp app on shutdown
+    async def on_shutdown(self, app):
+        app["api_spec_refresh"].cancel()
+        await get_search_client().aclose()
+        await asyncio.get_running_loop().run_in_executor(None, self.resources.chat_history.close)
     
     # Function to show welcome message to new users
     async def on_members_added_activity(self, members_added: ChannelAccount, turn_context: TurnContext):
@@ -75,62 +424,33 @@ class MyBot(ActivityHandler):
         # Setting the query to send to OpenAI
         input_text = turn_context.activity.text + "\n\n metadata:\n" + str(input_text_metadata)    
             
-        # Set Callback Handler
-        cb_handler = BotServiceCallbackHandler(turn_context)
-        cb_manager = CallbackManager(handlers=[cb_handler])
-
-        # Set LLM 
-        llm = AzureChatOpenAI(deployment_name=self.model_name, temperature=0.5, max_tokens=1000, callback_manager=cb_manager)
-
-        # Initialize our Tools/Experts
-        text_indexes = ["cogsrch-index-files", "cogsrch-index-csv"]
-        doc_search = DocSearchAgent(llm=llm, indexes=text_indexes,
-                           k=10, similarity_k=4, reranker_th=1,
-                           sas_token=os.environ['BLOB_SAS_TOKEN'],
-                           callback_manager=cb_manager, return_direct=True)
-        vector_only_indexes = ["cogsrch-index-books-vector"]
-        book_search = DocSearchAgent(llm=llm, vector_only_indexes = vector_only_indexes,
-                           k=10, similarity_k=10, reranker_th=1,
-                           sas_token=os.environ['BLOB_SAS_TOKEN'],
-                           callback_manager=cb_manager, return_direct=True,
-                           name="@booksearch",
-                           description="useful when the questions includes the term: @booksearch.\n")
-        www_search = BingSearchAgent(llm=llm, k=5, callback_manager=cb_manager, return_direct=True)
-        sql_search = SQLSearchAgent(llm=llm, k=10, callback_manager=cb_manager, return_direct=True)
-        chatgpt_search = ChatGPTTool(llm=llm, callback_manager=cb_manager, return_direct=True)
-        
-        url = 'https://disease.sh/apidocs/swagger_v3.json'
-        spec = requests.get(url).json()
+        # Set Callback Handler, the answer is only streamed on channels that can update a message
+        streaming = self.streaming and turn_context.activity.channel_id in self.streaming_channels
+        if streaming:
+            cb_handler = BotServiceStreamingCallbackHandler(turn_context, interval=self.status_update_interval)
+        else:
+            cb_handler = BotServiceCallbackHandler(turn_context, interval=self.status_update_interval)
 
-        api_search = APISearchAgent(llm=llm,
-                            llm_search=AzureChatOpenAI(deployment_name="gpt-35-turbo-16k", temperature=0, max_tokens=1000),
-                            api_spec=str(reduce_openapi_spec(spec)), 
-                            limit_to_domains=["https://disease.sh/"],
-                            callback_manager=cb_manager, return_direct=True)
-
-        tools = [www_search, sql_search, doc_search, chatgpt_search, book_search, api_search]
-
-        # Set brain Agent with persisten memory in CosmosDB
-        cosmos = CosmosDBChatMessageHistory(
-                        cosmos_endpoint=os.environ['AZURE_COSMOSDB_ENDPOINT'],
-                        cosmos_database=os.environ['AZURE_COSMOSDB_NAME'],
-                        cosmos_container=os.environ['AZURE_COSMOSDB_CONTAINER_NAME'],
-                        connection_string=os.environ['AZURE_COMOSDB_CONNECTION_STRING'],
-                        session_id=session_id,
-                        user_id=user_id
-                    )
-        cosmos.prepare_cosmos()
-        memory = ConversationBufferWindowMemory(memory_key="chat_history", return_messages=True, k=30, chat_memory=cosmos)
-        agent = ConversationalChatAgent.from_llm_and_tools(llm=llm, tools=tools,system_message=CUSTOM_CHATBOT_PREFIX,human_message=CUSTOM_CHATBOT_SUFFIX)
-        agent_chain = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, memory=memory, handle_parsing_errors=True)
+        # Set brain Agent with persisten memory in CosmosDB, only once the pool admitted the turn:
+        # rejected turns do not load a session into the history window
+        async def run_turn():
+            agent_chain = await self.resources.get_agent_chain(session_id, user_id)
+            return await arun_agent(input_text, agent_chain, [cb_handler])
 
         await turn_context.send_activity(Activity(type=ActivityTypes.typing))
         
-        # Please note below that running a non-async function like run_agent in a separate thread won't make it truly asynchronous. It allows the function to be called without blocking the event loop, but it may still have synchronous behavior internally.
-        loop = asyncio.get_event_loop()
-        answer = await loop.run_in_executor(ThreadPoolExecutor(), run_agent, input_text, agent_chain)
+        # The agent and its tools run natively async on the event loop, no thread is used per turn
+        try:
+            answer = await self.worker_pool.arun(run_turn)
+        except WorkerPoolBusy:
+            answer = BUSY_MESSAGE
+        finally:
+            cb_handler.close()
         
-        await turn_context.send_activity(answer)
+        if streaming:
+            await cb_handler.finish(answer)
+        else:
+            await turn_context.send_activity(answer)
 
 
 
@@ -10,3 +10,11 @@ class DefaultConfig:
     PORT = 3978
     APP_ID = os.environ.get("MicrosoftAppId", "")
     APP_PASSWORD = os.environ.get("MicrosoftAppPassword", "")
+    AGENT_QUEUE_SIZE = int(os.environ.get("AGENT_QUEUE_SIZE", 16))
+    AGENT_CONCURRENT_TURNS = int(os.environ.get("AGENT_CONCURRENT_TURNS", 256))
+    STATUS_UPDATE_INTERVAL = float(os.environ.get("STATUS_UPDATE_INTERVAL", 1.0))
+    STREAMING = os.environ.get("STREAMING", "false").lower() == "true"
+    # Channels that can update a sent message, the others (Direct Line / Web Chat, ...) get the answer in one message
+    STREAMING_CHANNELS = [c.strip() for c in os.environ.get("STREAMING_CHANNELS", "msteams,slack").split(",") if c.strip()]
+    CHAT_HISTORY_MAX_SESSIONS = int(os.environ.get("CHAT_HISTORY_MAX_SESSIONS", 1000))
+    CHAT_HISTORY_FLUSH_INTERVAL = float(os.environ.get("CHAT_HISTORY_FLUSH_INTERVAL", 1.0))
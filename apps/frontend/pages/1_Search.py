@@ -5,15 +5,16 @@ import re
 import time
 import random
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 from langchain.docstore.document import Document
 from langchain.chat_models import AzureChatOpenAI
-from langchain.embeddings import AzureOpenAIEmbeddings
+from langchain.callbacks.base import BaseCallbackHandler
 from utils import (
         get_search_results,
-        update_vector_indexes,
+        get_vectorization_queue,
+        get_embedder,
         model_tokens_limit,
-        num_tokens_from_docs,
-        num_tokens_from_string,
         get_answer,
     )
 st.set_page_config(page_title="GPT Smart Search", page_icon="📖", layout="wide")
@@ -34,6 +35,57 @@ def clear_submit():
     st.session_state["submit"] = False
 
 
+# Clients are created once per server process, not on every rerun
+@st.cache_resource
+def load_llm(model: str) -> AzureChatOpenAI:
+    return AzureChatOpenAI(deployment_name=model, temperature=0.5, max_tokens=1000, streaming=True)
+
+@st.cache_resource
+def load_embedder(model: str):
+    return get_embedder(model)
+
+
+# Results are cached by get_search_results (use_cache), which drops them as soon as the vectorization updates an index,
+# so new documents are submitted again and their vector results show up without waiting for a TTL
+def search(query: str, text_indexes: list, top_k: int, top_similarity_k: int) -> OrderedDict:
+    embedder = load_embedder("text-embedding-ada-002")
+    vector_indexes = [index+"-vector" for index in text_indexes]
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Embed the query while searching in text-based indexes
+        query_vector = executor.submit(embedder.embed_query, query)
+        
+        # Search in text-based indexes first and queue the vectorization of new documents
+        ordered_results = get_search_results(query, text_indexes, k=top_k, 
+                                                reranker_threshold=1,
+                                                vector_search=False,
+                                                use_cache=True)
+        
+        get_vectorization_queue(embedder).submit(ordered_results, wait_ms=int(os.environ.get("VECTORIZATION_WAIT_MS", 0)))
+
+        # Search in all vector-based indexes available
+        return get_search_results(query, vector_indexes, k=top_k , vector_search=True, 
+                                    similarity_k=top_similarity_k,
+                                    query_vector = query_vector.result(),
+                                    use_cache=True)
+
+
+# Writes the answer in the placeholder while the LLM generates it
+class StreamlitAnswerCallbackHandler(BaseCallbackHandler):
+    
+    def __init__(self, placeholder, interval: float = 0.05) -> None:
+        self.placeholder = placeholder
+        self.interval = interval
+        self.text = ""
+        self.last_render = 0
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.text += token
+        if time.monotonic() - self.last_render > self.interval:
+            self.placeholder.markdown(self.text + "▌", unsafe_allow_html=True)
+            self.last_render = time.monotonic()
+
+
 with st.sidebar:
     st.markdown("""# Instructions""")
     st.markdown("""
@@ -80,8 +132,7 @@ else:
     os.environ["OPENAI_API_VERSION"] = os.environ["AZURE_OPENAI_API_VERSION"]
     
     MODEL = os.environ.get("AZURE_OPENAI_MODEL_NAME")
-    llm = AzureChatOpenAI(deployment_name=MODEL, temperature=0.5, max_tokens=1000)
-    embedder = AzureOpenAIEmbeddings(model="text-embedding-ada-002", skip_empty=True)  
+    llm = load_llm(MODEL)
                            
     if button or st.session_state.get("submit"):
         if not query:
@@ -93,26 +144,14 @@ else:
                 index1_name = "cogsrch-index-files"
                 index2_name = "cogsrch-index-csv"
                 text_indexes = [index1_name, index2_name]
-                vector_indexes = [index+"-vector" for index in text_indexes]
-                
-                # Search in text-based indexes first and update vector indexes
-                top_k=10
-                ordered_results = get_search_results(query, text_indexes, k=top_k, 
-                                                        reranker_threshold=1,
-                                                        vector_search=False)
-                
-                update_vector_indexes(ordered_search_results=ordered_results, embedder=embedder)
-
-                # Search in all vector-based indexes available
-                top_similarity_k = 5
-                ordered_results = get_search_results(query, vector_indexes, k=top_k , vector_search=True, 
-                                                        similarity_k=top_similarity_k,
-                                                        query_vector = embedder.embed_query(query))
                 
+                ordered_results = search(query, text_indexes, top_k=10, top_similarity_k=5)
 
                 st.session_state["submit"] = True
                 # Output Columns
-                placeholder = st.empty()
+                st.markdown("#### Answer")
+                answer_placeholder = st.empty()
+                st.markdown("---")
 
             except Exception as e:
                 st.markdown("Not data returned from Azure Search, check connection..")
@@ -126,26 +165,8 @@ else:
                         top_docs.append(Document(page_content=value["chunk"], metadata={"source": location+os.environ['BLOB_SAS_TOKEN']}))
                         add_text = "Reading the source documents to provide the best answer... ⏳"
 
-                    if "add_text" in locals():
-                        with st.spinner(add_text):
-                            if(len(top_docs)>0):
-                                tokens_limit = model_tokens_limit(MODEL)
-                                num_tokens = num_tokens_from_docs(top_docs)
-                                chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"  
-                                answer = get_answer(llm=llm, docs=top_docs, 
-                                                    query=query, language=language, chain_type=chain_type) 
-                                
-                            else:
-                                answer = {"output_text":"No results found" }
-                    else:
-                        answer = {"output_text":"No results found" }
-
-
-                    with placeholder.container():
-
-                        st.markdown("#### Answer")
-                        st.markdown(answer["output_text"], unsafe_allow_html=True)
-                        st.markdown("---")
+                    # Show the search results right away, the answer is written above them while it is generated
+                    with st.container():
                         st.markdown("#### Search Results")
 
                         if(len(top_docs)>0):
@@ -158,5 +179,21 @@ else:
                                 st.markdown(value["caption"])
                                 st.markdown("---")
 
+                    if "add_text" in locals():
+                        answer_placeholder.markdown(add_text)
+                        if(len(top_docs)>0):
+                            # "packed" is a single stuff call on the docs that fit once the prompt and completion budgets are taken
+                            answer = get_answer(llm=llm, docs=top_docs, 
+                                                query=query, language=language, chain_type="packed",
+                                                tokens_limit=model_tokens_limit(MODEL),
+                                                callbacks=[StreamlitAnswerCallbackHandler(answer_placeholder)]) 
+                            
+                        else:
+                            answer = {"output_text":"No results found" }
+                    else:
+                        answer = {"output_text":"No results found" }
+
+                    answer_placeholder.markdown(answer["output_text"], unsafe_allow_html=True)
+
                 except Exception as e:
                     st.error(e)
\ No newline at end of file
@@ -116,6 +116,9 @@ Feel free to ask any question and specify the tool you'd like me to utilize. I'm
 """
 
 
+BUSY_MESSAGE = """I'm receiving a lot of questions right now \U0001F605, please try again in a few seconds."""
+
+
 CUSTOM_CHATBOT_PREFIX = """
 # Instructions
 ## On your profile and general capabilities:
@@ -349,6 +352,14 @@ You are an agent designed to interact with a SQL database.
 
 """
 
+MSSQL_AGENT_TABLES = """
+## Relevant tables:
+These are the tables of the database most related to the question, with their columns, types and a few sample values. Use them to write your query, only look for other tables or for more details with the tools if they are not enough.
+
+{tables}
+
+"""
+
 MSSQL_AGENT_FORMAT_INSTRUCTIONS = """
 
 ## Use the following format:
@@ -382,6 +393,14 @@ SELECT [death] FROM covidtracking WHERE state = 'TX' AND date LIKE '2020%'"
 
 """
 
+# Same format for DuckDB (tabular files queried with SQL), which uses LIMIT instead of TOP and "" instead of []
+DUCKDB_AGENT_FORMAT_INSTRUCTIONS = MSSQL_AGENT_FORMAT_INSTRUCTIONS.replace(
+    "SELECT TOP (10) [death] FROM covidtracking WHERE state = 'TX' AND date LIKE '2020%'",
+    "SELECT \"death\" FROM covidtracking WHERE state = 'TX' AND year(date) = 2020 LIMIT 10").replace(
+    "SELECT [death] FROM covidtracking WHERE state = 'TX' AND date LIKE '2020%'",
+    "SELECT \"death\" FROM covidtracking WHERE state = 'TX' AND year(date) = 2020")
+
+
 
 CSV_PROMPT_PREFIX = """
 First set the pandas display options to show all the columns, get the column names, then answer the question.
@@ -4,42 +4,67 @@ import json
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Awaitable, Callable, Tuple, Type, Union
 import requests
-
-from collections import OrderedDict
+import asyncio
+import threading
+import aiohttp
+from requests.adapters import HTTPAdapter
+
+from collections import OrderedDict, deque
+import queue
+import sqlite3
+import tempfile
 import base64
+from functools import lru_cache
+import copy
+import hashlib
+import atexit
+import math
+from collections import Counter
+from array import array
+from decimal import Decimal
 
 import docx2txt
+import pandas as pd
 import tiktoken
 import html
 import time
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager, ExitStack
 from typing import List, Tuple
 from pypdf import PdfReader, PdfWriter
 from dataclasses import dataclass
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.types import NullType
+from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import URL
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 
 from langchain.embeddings import AzureOpenAIEmbeddings
+from langchain.schema.embeddings import Embeddings
 from langchain.docstore.document import Document
 from langchain.llms import AzureOpenAI
 from langchain.chat_models import AzureChatOpenAI
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import BaseOutputParser, OutputParserException
+from langchain.schema import BaseOutputParser, OutputParserException, BaseChatMessageHistory
+from langchain.schema.messages import BaseMessage, messages_from_dict, message_to_dict
 from langchain.vectorstores import VectorStore
 from langchain.vectorstores.faiss import FAISS
 from langchain.chains import LLMChain
 from langchain.memory import ConversationBufferMemory
-from langchain_experimental.agents.agent_toolkits import create_csv_agent
+from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
 from langchain.tools import BaseTool
 from langchain.prompts import PromptTemplate
 from langchain.sql_database import SQLDatabase
+from langchain.utilities.sql_database import truncate_word
 from langchain.agents import AgentExecutor, initialize_agent, AgentType
 from langchain.utilities import BingSearchAPIWrapper
 from langchain.agents import create_sql_agent
 from langchain.agents.agent_toolkits import SQLDatabaseToolkit
 from langchain.callbacks.base import BaseCallbackManager
+from langchain.callbacks.manager import CallbackManagerForToolRun, AsyncCallbackManagerForToolRun, Callbacks
 from langchain.requests import RequestsWrapper
 from langchain.chains import APIChain
 from langchain.agents.agent_toolkits.openapi.spec import reduce_openapi_spec
@@ -50,12 +75,12 @@ from langchain.utils.json_schema import dereference_refs
 try:
     from .prompts import (COMBINE_QUESTION_PROMPT, COMBINE_PROMPT, COMBINE_CHAT_PROMPT,
                           CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_PROMPT, MSSQL_AGENT_PREFIX, 
-                          MSSQL_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX, DOCSEARCH_PROMPT_PREFIX, APISEARCH_PROMPT_PREFIX)
+                          MSSQL_AGENT_TABLES, MSSQL_AGENT_FORMAT_INSTRUCTIONS, DUCKDB_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX, DOCSEARCH_PROMPT_PREFIX, APISEARCH_PROMPT_PREFIX)
 except Exception as e:
     print(e)
     from prompts import (COMBINE_QUESTION_PROMPT, COMBINE_PROMPT, COMBINE_CHAT_PROMPT,
                           CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_PROMPT, MSSQL_AGENT_PREFIX, 
-                          MSSQL_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX, DOCSEARCH_PROMPT_PREFIX, APISEARCH_PROMPT_PREFIX)
+                          MSSQL_AGENT_TABLES, MSSQL_AGENT_FORMAT_INSTRUCTIONS, DUCKDB_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX, DOCSEARCH_PROMPT_PREFIX, APISEARCH_PROMPT_PREFIX)
 
 
 def text_to_base64(text):
@@ -71,27 +96,215 @@ def text_to_base64(text):
     return base64_text
 
 
-def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+def group_cells_by_row(table):
+    """Cells of the table bucketed by row in one pass, sorted by column"""
+    rows = [[] for i in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
     for row_cells in rows:
-        table_html += "<tr>"
+        row_cells.sort(key=lambda cell: cell.column_index)
+    return rows
+
+def table_to_html(table):
+    table_html = ["<table>"]
+    for row_cells in group_cells_by_row(table):
+        table_html.append("<tr>")
         for cell in row_cells:
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrecognizerkey=None, model="prebuilt-document", from_url=False, verbose=False):
-    """Parses PDFs using PyPDF or Azure Document Intelligence SDK (former Azure Form Recognizer)"""
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
+
+def table_to_grid(table):
+    """Rows x columns of cell contents, the positions covered by a spanning cell are left empty"""
+    column_count = max([table.column_count] + [cell.column_index + 1 for cell in table.cells])
+    grid = []
+    for row_cells in group_cells_by_row(table):
+        row = [""] * column_count
+        for cell in row_cells:
+            row[cell.column_index] = " ".join(cell.content.split())
+        grid.append(row)
+    return grid
+
+def table_to_markdown(table):
+    """Compact rendering of the table, uses fewer tokens than html. The first row is the header"""
+    grid = table_to_grid(table)
+    if not grid:
+        return ""
+    lines = ["| " + " | ".join(value.replace("|", "\\|") for value in row) + " |" for row in grid]
+    lines.insert(1, "|" + "---|" * len(grid[0]))
+    return "\n" + "\n".join(lines) + "\n"
+
+def table_to_tsv(table):
+    """Most compact rendering of the table: one line per row, tab separated values"""
+    return "\n" + "\n".join("\t".join(row) for row in table_to_grid(table)) + "\n"
+
+TABLE_RENDERERS = {"html": table_to_html, "markdown": table_to_markdown, "tsv": table_to_tsv}
+
+def build_page_text(content, page_offset, page_length, tables_on_page, table_format="html"):
+    """Text of a page with the characters of each table replaced by its rendering (html, markdown or tsv),
+    placed where the table starts. Where table spans overlap, the last table wins."""
+    render_table = TABLE_RENDERERS[table_format]
+    # cut the page at every table span boundary, each piece belongs to the last table covering it (or none)
+    boundaries = {0, page_length}
+    starts = dict()
+    ends = dict()
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start = max(span.offset - page_offset, 0)
+            end = min(span.offset - page_offset + span.length, page_length)
+            if start < end:
+                boundaries.update((start, end))
+                starts.setdefault(start, []).append(table_id)
+                ends.setdefault(end, []).append(table_id)
+
+    parts = []
+    added_tables = set()
+    active = Counter()
+    boundaries = sorted(boundaries)
+    for start, end in zip(boundaries, boundaries[1:]):
+        for table_id in ends.get(start, []):
+            active[table_id] -= 1
+            if active[table_id] == 0:
+                del active[table_id]
+        for table_id in starts.get(start, []):
+            active[table_id] += 1
+        
+        if not active:
+            parts.append(content[page_offset + start:page_offset + end])
+        else:
+            table_id = max(active)
+            if table_id not in added_tables:
+                parts.append(render_table(tables_on_page[table_id]))
+                added_tables.add(table_id)
+
+    parts.append(" ")
+    return "".join(parts)
+
+
+# PyPDF text extraction in worker processes, files and page ranges of big files are extracted in parallel
+def extract_pdf_pages(path, start, end):
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+@contextmanager
+def local_pdf_path(file):
+    """Path of the PDF, file-like objects (e.g. uploaded files) are written to a temporary file for the worker processes"""
+    if isinstance(file, (str, os.PathLike)):
+        yield file
+        return
+    data = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(data)
+    try:
+        yield tmp.name
+    finally:
+        os.remove(tmp.name)
+
+def submit_pdf_pages(path, executor, pages_per_task=50):
+    """Submits the extraction of the PDF in ranges of pages_per_task pages, returns the futures in page order"""
+    page_count = len(PdfReader(path).pages)
+    return [executor.submit(extract_pdf_pages, path, start, min(start + pages_per_task, page_count))
+            for start in range(0, page_count, pages_per_task)]
+
+def iter_page_map(futures):
+    """Yields the (page_num, offset, page_text) of the pages as soon as their range and all the previous ones are done,
+    so offsets are the same as with a serial parse"""
+    page_num = 0
+    offset = 0
+    try:
+        for future in futures:
+            for page_text in future.result():
+                yield (page_num, offset, page_text)
+                offset += len(page_text)
+                page_num += 1
+    finally:
+        for future in futures:
+            future.cancel()
+
+def iter_pdf_pages(file, max_workers=None, pages_per_task=50):
+    """Generator version of parse_pdf with PyPDF, the page ranges are extracted by max_workers processes (all the cores by default)"""
+    with local_pdf_path(file) as path, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from iter_page_map(submit_pdf_pages(path, executor, pages_per_task))
+
+
+# Document Intelligence: big PDFs are analyzed as page-range parts, parts and files concurrently
+def form_recognizer_page_texts(form_recognizer_results, table_format="html"):
+    """Text of each page of an analysis result, with the tables rendered as table_format"""
+    # group the tables by page once, in the order of the results
+    tables_by_page = dict()
+    for table in form_recognizer_results.tables:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+
+    page_texts = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+        page_texts.append(build_page_text(form_recognizer_results.content, page.spans[0].offset, page.spans[0].length, tables_on_page, table_format))
+    return page_texts
+
+def pdf_bytes(file):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            return f.read()
+    return file.getvalue() if hasattr(file, "getvalue") else file.read()
+
+def split_pdf(file, pages_per_part):
+    """Splits the PDF in parts of pages_per_part pages, returns the bytes of each part"""
+    reader = PdfReader(BytesIO(pdf_bytes(file)))
+    parts = []
+    for start in range(0, len(reader.pages), pages_per_part):
+        writer = PdfWriter()
+        for i in range(start, min(start + pages_per_part, len(reader.pages))):
+            writer.add_page(reader.pages[i])
+        buffer = BytesIO()
+        writer.write(buffer)
+        parts.append(buffer.getvalue())
+    return parts
+
+def get_form_recognizer_client(endpoint=None, key=None):
+    credential = AzureKeyCredential(key or os.environ["FORM_RECOGNIZER_KEY"])
+    return DocumentAnalysisClient(endpoint=endpoint or os.environ["FORM_RECOGNIZER_ENDPOINT"], credential=credential)
+
+def analyze_pdf_files(files, form_recognizer_client, model="prebuilt-document", pages_per_part=None, max_concurrency=4, table_format="html", verbose=False):
+    """Analyzes the PDFs with Document Intelligence, at most max_concurrency jobs at a time. With pages_per_part, each PDF is
+    split in parts of that many pages analyzed as separate jobs. Returns the page_map of each file, parts stitched back
+    with the page numbers and offsets of the whole file."""
+    documents = [] # (file index, bytes) of every job, in page order
+    for file_index, file in enumerate(files):
+        parts = split_pdf(file, pages_per_part) if pages_per_part else [pdf_bytes(file)]
+        documents.extend((file_index, part) for part in parts)
+    if verbose: print(f"Analyzing {len(files)} files in {len(documents)} parts, {max_concurrency} at a time")
+
+    def analyze(document):
+        return form_recognizer_client.begin_analyze_document(model, document=document[1]).result()
+
+    page_maps = [[] for file in files]
+    offsets = [0 for file in files]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(documents)))) as executor:
+        for (file_index, part), form_recognizer_results in zip(documents, executor.map(analyze, documents)):
+            for page_text in form_recognizer_page_texts(form_recognizer_results, table_format):
+                page_maps[file_index].append((len(page_maps[file_index]), offsets[file_index], page_text))
+                offsets[file_index] += len(page_text)
+    return page_maps
+
+
+def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrecognizerkey=None, model="prebuilt-document", from_url=False, verbose=False, table_format="html",
+              max_workers=1, pages_per_task=50, pages_per_part=None, max_concurrency=4, form_recognizer_client=None):
+    """Parses PDFs using PyPDF or Azure Document Intelligence SDK (former Azure Form Recognizer).
+    With Document Intelligence, tables are rendered as table_format: "html", or "markdown"/"tsv" to use fewer tokens,
+    and a local PDF can be analyzed in parts of pages_per_part pages, max_concurrency at a time (see analyze_pdf_files).
+    With PyPDF and max_workers != 1, ranges of pages_per_task pages are extracted by max_workers processes (None for all the cores)."""
     offset = 0
     page_map = []
     if not form_recognizer:
         if verbose: print(f"Extracting text using PyPDF")
+        if max_workers != 1:
+            return list(iter_pdf_pages(file, max_workers=max_workers, pages_per_task=pages_per_task))
         reader = PdfReader(file)
         pages = reader.pages
         for page_num, p in enumerate(pages):
@@ -100,8 +313,11 @@ def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrec
             offset += len(page_text)
     else:
         if verbose: print(f"Extracting text using Azure Document Intelligence")
-        credential = AzureKeyCredential(os.environ["FORM_RECOGNIZER_KEY"])
-        form_recognizer_client = DocumentAnalysisClient(endpoint=os.environ["FORM_RECOGNIZER_ENDPOINT"], credential=credential)
+        form_recognizer_client = form_recognizer_client or get_form_recognizer_client(formrecognizer_endpoint, formrecognizerkey)
+        
+        if pages_per_part and not from_url:
+            return analyze_pdf_files([file], form_recognizer_client, model=model, pages_per_part=pages_per_part,
+                                     max_concurrency=max_concurrency, table_format=table_format, verbose=verbose)[0]
         
         if not from_url:
             with open(file, "rb") as filename:
@@ -111,47 +327,46 @@ def parse_pdf(file, form_recognizer=False, formrecognizer_endpoint=None, formrec
             
         form_recognizer_results = poller.result()
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
+        for page_num, page_text in enumerate(form_recognizer_page_texts(form_recognizer_results, table_format)):
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
 
     return page_map    
 
 
-def read_pdf_files(files, form_recognizer=False, verbose=False, formrecognizer_endpoint=None, formrecognizerkey=None):
-    """This function will go through pdf and extract and return list of page texts (chunks)."""
+def read_pdf_files(files, form_recognizer=False, verbose=False, formrecognizer_endpoint=None, formrecognizerkey=None, table_format="html",
+                   max_workers=1, pages_per_task=50, pages_per_part=None, max_concurrency=1, form_recognizer_client=None):
+    """This function will go through pdf and extract and return list of page texts (chunks).
+    With PyPDF and max_workers != 1, all the files (and page ranges of the big ones) are extracted in parallel by max_workers processes.
+    With Document Intelligence and max_concurrency != 1 or pages_per_part, files (and their parts) are analyzed concurrently."""
     text_list = []
     sources_list = []
-    for file in files:
-        page_map = parse_pdf(file, form_recognizer=form_recognizer, verbose=verbose, formrecognizer_endpoint=formrecognizer_endpoint, formrecognizerkey=formrecognizerkey)
-        for page in enumerate(page_map):
-            text_list.append(page[1][2])
-            sources_list.append(file.name + "_page_"+str(page[1][0]+1))
+    if form_recognizer and (max_concurrency != 1 or pages_per_part):
+        page_maps = analyze_pdf_files(files, form_recognizer_client or get_form_recognizer_client(formrecognizer_endpoint, formrecognizerkey),
+                                      pages_per_part=pages_per_part, max_concurrency=max_concurrency, table_format=table_format, verbose=verbose)
+        for file, page_map in zip(files, page_maps):
+            for page_num, offset, page_text in page_map:
+                text_list.append(page_text)
+                sources_list.append(file.name + "_page_"+str(page_num+1))
+        return [text_list,sources_list]
+    
+    if form_recognizer or max_workers == 1:
+        for file in files:
+            page_map = parse_pdf(file, form_recognizer=form_recognizer, verbose=verbose, formrecognizer_endpoint=formrecognizer_endpoint, formrecognizerkey=formrecognizerkey, table_format=table_format)
+            for page in enumerate(page_map):
+                text_list.append(page[1][2])
+                sources_list.append(file.name + "_page_"+str(page[1][0]+1))
+        return [text_list,sources_list]
+    
+    with ExitStack() as stack:
+        paths = [stack.enter_context(local_pdf_path(file)) for file in files]
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+        # Submit every file first so that all of them are extracted at the same time
+        futures = [submit_pdf_pages(path, executor, pages_per_task) for path in paths]
+        for file, file_futures in zip(files, futures):
+            for page_num, offset, page_text in iter_page_map(file_futures):
+                text_list.append(page_text)
+                sources_list.append(file.name + "_page_"+str(page_num+1))
     return [text_list,sources_list]
     
     
@@ -201,12 +416,197 @@ def text_to_docs(text: List[str]) -> List[Document]:
     return doc_chunks
 
 
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedder with a content-addressed cache keyed by (model, sha256(text)).
+    The first tier is an in-process LRU bounded by the size of the stored float32 vectors,
+    the second tier is an optional SQLite file shared across processes and restarts."""
+    
+    def __init__(self, embedder: Embeddings, model: str = None, max_memory_bytes: int = 64*1024*1024,
+                 persist_path: str = None, db_timeout: float = 1.0):
+        self.embedder = embedder
+        self.model = model or getattr(embedder, "deployment", None) or getattr(embedder, "model", "")
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict() # sha256 -> float32 bytes
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+        self.db = None
+        self.db_lock = threading.Lock() # Disk I/O never holds self.lock, so memory hits don't wait for it
+        if persist_path:
+            try:
+                # Shared by several processes: wait a bit for a lock, then treat it as a miss
+                self.db = sqlite3.connect(persist_path, timeout=db_timeout, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))")
+                self.db.commit()
+            except sqlite3.OperationalError as e:
+                print("Exception:",e)
+                self.db = None
+    
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    
+    def _put_memory(self, key: str, vector: bytes):
+        # Must be called with self.lock held
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = vector
+        self.memory_bytes += len(vector)
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            key, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+    
+    def _get_memory(self, keys: List[str]) -> Dict[str, bytes]:
+        found = dict()
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            self.hits += len(found)
+        return found
+    
+    def _get_disk(self, keys: List[str]) -> Dict[str, bytes]:
+        found = dict()
+        if not keys or self.db is None:
+            return found
+        try:
+            with self.db_lock:
+                for start in range(0, len(keys), 500): # SQLite caps the number of query parameters
+                    batch = keys[start:start + 500]
+                    rows = self.db.execute(f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?'*len(batch))})",
+                                           [self.model] + batch).fetchall()
+                    found.update(rows)
+        except sqlite3.OperationalError as e: # Locked by another process: a miss, not a failure
+            print("Exception:",e)
+        with self.lock:
+            for key, vector in found.items():
+                self._put_memory(key, vector)
+            self.disk_hits += len(found)
+        return found
+    
+    def _count_misses(self, keys: List[str], found: Dict[str, bytes]):
+        with self.lock:
+            self.misses += len(keys) - len(found)
+    
+    def _get(self, keys: List[str]) -> Dict[str, bytes]:
+        found = self._get_memory(keys)
+        found.update(self._get_disk([key for key in keys if key not in found]))
+        self._count_misses(keys, found)
+        return found
+    
+    async def _aget(self, keys: List[str]) -> Dict[str, bytes]:
+        # Only the memory tier runs on the event loop, the SQLite file is read in a thread
+        found = self._get_memory(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self.db is not None:
+            found.update(await asyncio.to_thread(self._get_disk, missing))
+        self._count_misses(keys, found)
+        return found
+    
+    def _put_memory_all(self, vectors: Dict[str, bytes]):
+        with self.lock:
+            for key, vector in vectors.items():
+                self._put_memory(key, vector)
+    
+    def _put_disk(self, vectors: Dict[str, bytes]):
+        if self.db is None:
+            return
+        try:
+            with self.db_lock:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                                    [(self.model, key, vector) for key, vector in vectors.items()])
+                self.db.commit()
+        except sqlite3.OperationalError as e: # Not persisted this time, still cached in memory
+            print("Exception:",e)
+    
+    def _put(self, vectors: Dict[str, bytes]):
+        self._put_memory_all(vectors)
+        self._put_disk(vectors)
+    
+    async def _aput(self, vectors: Dict[str, bytes]):
+        self._put_memory_all(vectors)
+        if self.db is not None:
+            await asyncio.to_thread(self._put_disk, vectors)
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._hash(text) for text in texts]
+        found = self._get(list(OrderedDict.fromkeys(keys)))
+        
+        # Embed each missing text only once, even if it is repeated in texts
+        missing = OrderedDict((key, text) for key, text in zip(keys, texts) if key not in found)
+        if missing:
+            vectors = self.embedder.embed_documents(list(missing.values()))
+            new = {key: array("f", vector).tobytes() for key, vector in zip(missing, vectors)}
+            self._put(new)
+            found.update(new)
+        
+        return [array("f", found[key]).tolist() for key in keys]
+    
+    def embed_query(self, text: str) -> List[float]:
+        key = self._hash(text)
+        found = self._get([key])
+        if key not in found:
+            found[key] = array("f", self.embedder.embed_query(text)).tobytes()
+            self._put(found)
+        return array("f", found[key]).tolist()
+    
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._hash(text) for text in texts]
+        found = await self._aget(list(OrderedDict.fromkeys(keys)))
+        missing = OrderedDict((key, text) for key, text in zip(keys, texts) if key not in found)
+        if missing:
+            vectors = await self.embedder.aembed_documents(list(missing.values()))
+            new = {key: array("f", vector).tobytes() for key, vector in zip(missing, vectors)}
+            await self._aput(new)
+            found.update(new)
+        return [array("f", found[key]).tolist() for key in keys]
+    
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._hash(text)
+        found = await self._aget([key])
+        if key not in found:
+            found[key] = array("f", await self.embedder.aembed_query(text)).tobytes()
+            await self._aput(found)
+        return array("f", found[key]).tolist()
+    
+    def metrics(self) -> dict:
+        """Returns the hit/miss counters and the size of the memory tier"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+            }
+
+
+embedders = dict()
+embedders_lock = threading.Lock()
+
+def get_embedder(model: str = "text-embedding-ada-002") -> CachedEmbeddings:
+    """Returns the process-wide cached AzureOpenAIEmbeddings for a model.
+    The memory budget is set with EMBEDDINGS_CACHE_MAX_MB, the SQLite tier is only used when EMBEDDINGS_CACHE_PATH is set."""
+    with embedders_lock:
+        if model not in embedders:
+            embedders[model] = CachedEmbeddings(
+                AzureOpenAIEmbeddings(model=model, skip_empty=True), model=model,
+                max_memory_bytes=int(os.environ.get("EMBEDDINGS_CACHE_MAX_MB", 64))*1024*1024,
+                persist_path=os.environ.get("EMBEDDINGS_CACHE_PATH"))
+        return embedders[model]
+
+
 def embed_docs_faiss(docs: List[Document], chunks_limit: int=100, verbose: bool = False) -> VectorStore:
     """Embeds a list of Documents and returns a FAISS index"""
  
     # Select the Embedder model'
     if verbose: print("Number of chunks:",len(docs))
-    embedder = AzureOpenAIEmbeddings(model="text-embedding-ada-002", skip_empty=True) 
+    embedder = get_embedder("text-embedding-ada-002")
     
     if len(docs) > chunks_limit:
         docs = docs[:chunks_limit]
@@ -235,35 +635,71 @@ def wrap_text_in_html(text: List[str]) -> str:
     return "".join([f"<p>{line}</p>" for line in text.split("\n")])
 
 
-# Returns the num of tokens used on a string
-def num_tokens_from_string(string: str) -> int:
-    encoding_name ='cl100k_base'
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+# Token limits of the models we use, add new models with register_model
+MODEL_TOKEN_LIMITS = {
+    "gpt-35-turbo": 4096,
+    "gpt-4": 8192,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_MODEL_TOKEN_LIMIT = 4096
+
+def register_model(model: str, token_limit: int):
+    """Adds or updates the token limit of a model"""
+    MODEL_TOKEN_LIMITS[model] = token_limit
 
 # Returning the toekn limit based on model selection
 def model_tokens_limit(model: str) -> int:
     """Returns the number of tokens limits in a text model."""
-    if model == "gpt-35-turbo":
-        token_limit = 4096
-    elif model == "gpt-4":
-        token_limit = 8192
-    elif model == "gpt-35-turbo-16k":
-        token_limit = 16384
-    elif model == "gpt-4-32k":
-        token_limit = 32768
-    else:
-        token_limit = 4096
-    return token_limit
+    return MODEL_TOKEN_LIMITS.get(model, DEFAULT_MODEL_TOKEN_LIMIT)
+
+
+# tiktoken encodings are expensive to build, keep one per process
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = 'cl100k_base') -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+# Token counts memoized by chunk id or content hash
+TOKEN_COUNTS_MAX_ENTRIES = 100000
+token_counts = OrderedDict()
+token_counts_lock = threading.Lock()
+
+# Returns the num of tokens used on a string
+def num_tokens_from_string(string: str) -> int:
+    """Returns the number of tokens in a text string."""
+    return len(get_encoding().encode(string))
+
+def num_tokens_upper_bound(string: str) -> int:
+    """Cheap upper bound of the number of tokens, every cl100k token is at least one UTF-8 byte"""
+    return len(string.encode("utf-8"))
+
+def num_tokens_from_strings(strings: List[str], keys: List[str] = None, num_threads: int = 8) -> List[int]:
+    """Returns the number of tokens of each string. Counts are memoized by key (e.g. a chunk id),
+    or by the sha256 of the string, and the missing ones are counted with tiktoken's threaded encode_batch"""
+    keys = keys or [hashlib.sha256(string.encode("utf-8")).hexdigest() for string in strings]
+    with token_counts_lock:
+        counts = [token_counts.get(key) for key in keys]
+    
+    missing = OrderedDict((key, string) for key, string, count in zip(keys, strings, counts) if count is None)
+    if missing:
+        new_counts = dict(zip(missing, map(len, get_encoding().encode_batch(list(missing.values()), num_threads=num_threads))))
+        with token_counts_lock:
+            token_counts.update(new_counts)
+            while len(token_counts) > TOKEN_COUNTS_MAX_ENTRIES:
+                token_counts.popitem(last=False)
+        counts = [new_counts[key] if count is None else count for key, count in zip(keys, counts)]
+    
+    return counts
 
 # Returns num of toknes used on a list of Documents objects
-def num_tokens_from_docs(docs: List[Document]) -> int:
-    num_tokens = 0
-    for i in range(len(docs)):
-        num_tokens += num_tokens_from_string(docs[i].page_content)
-    return num_tokens
+def num_tokens_from_docs(docs: List[Document], keys: List[str] = None) -> int:
+    return sum(num_tokens_from_strings([doc.page_content for doc in docs], keys=keys))
+
+def docs_fit_in_tokens(docs: List[Document], tokens_limit: int, keys: List[str] = None) -> bool:
+    """Returns True if the Documents fit in tokens_limit, skipping the exact count when the upper bound already fits"""
+    if sum(num_tokens_upper_bound(doc.page_content) for doc in docs) <= tokens_limit:
+        return True
+    return num_tokens_from_docs(docs, keys=keys) <= tokens_limit
 
 
 @dataclass(frozen=True)
@@ -335,43 +771,192 @@ def reduce_openapi_spec(spec: dict, dereference: bool = True) -> ReducedOpenAPIS
     )
 
 
-def get_search_results(query: str, indexes: list, 
-                       k: int = 5,
-                       reranker_threshold: int = 1,
-                       sas_token: str = "",
-                       vector_search: bool = False,
-                       similarity_k: int = 3, 
-                       query_vector: list = []) -> List[dict]:
-    
-    headers = {'Content-Type': 'application/json','api-key': os.environ["AZURE_SEARCH_KEY"]}
-    params = {'api-version': os.environ['AZURE_SEARCH_API_VERSION']}
+# Shared pool used to fan out the per-index queries of get_search_results
+SEARCH_MAX_WORKERS = int(os.environ.get("AZURE_SEARCH_MAX_WORKERS", 8))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="search")
 
-    agg_search_results = dict()
+
+class AzureSearchClient:
+    """Pooled, keep-alive client for the Azure AI Search REST API.
+    Endpoint, key and api-version are read once; the sync calls share a requests.Session
+    and the async calls share an aiohttp.ClientSession, so TLS connections are reused across calls.
+    Responses are requested gzip-compressed and decoded transparently by both sessions."""
     
-    for index in indexes:
-        search_payload = {
-            "search": query,
-            "queryType": "semantic",
-            "semanticConfiguration": "my-semantic-config",
-            "count": "true",
-            "speller": "lexicon",
-            "queryLanguage": "en-us",
-            "captions": "extractive",
-            "answers": "extractive",
-            "top": k
-        }
-        if vector_search:
-            search_payload["vectors"]= [{"value": query_vector, "fields": "chunkVector","k": k}]
-            search_payload["select"]= "id, title, chunk, name, location"
-        else:
-            search_payload["select"]= "id, title, chunks, name, location, vectorized"
+    def __init__(self, endpoint: str = None, key: str = None, api_version: str = None,
+                 pool_maxsize: int = 16, timeout: float = None):
+        self.endpoint = (endpoint or os.environ['AZURE_SEARCH_ENDPOINT']).rstrip("/")
+        self.key = key or os.environ['AZURE_SEARCH_KEY']
+        self.api_version = api_version or os.environ['AZURE_SEARCH_API_VERSION']
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json', 'api-key': self.key, 'Accept-Encoding': 'gzip, deflate'}
+        self.params = {'api-version': self.api_version}
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.headers)
         
+        self._async_session = None
+        self._async_loop = None
+    
+    def post(self, path: str, payload: dict, timeout: float = None) -> requests.Response:
+        """Posts a json payload to a path relative to the search endpoint, e.g. /indexes/<index>/docs/search"""
+        return self.session.post(self.endpoint + path, data=json.dumps(payload), params=self.params,
+                                 timeout=timeout or self.timeout)
+    
+    def search(self, index: str, search_payload: dict, timeout: float = None) -> dict:
+        """Sends a search request to a single index and returns the json response.
+        Raises requests.HTTPError if the index answers with an error (throttled, missing index, ...)"""
+        response = self.post("/indexes/" + index + "/docs/search", search_payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    
+    def index_documents(self, index: str, documents: List[dict], timeout: float = None) -> requests.Response:
+        """Sends a batch of document actions (upload, merge, ...) to an index"""
+        return self.post("/indexes/" + index + "/docs/index", {"value": documents}, timeout=timeout)
+    
+    def get_async_session(self) -> aiohttp.ClientSession:
+        """Returns the aiohttp session of the running event loop, creating it on first use"""
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, keepalive_timeout=60)
+            self._async_session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+            self._async_loop = loop
+        return self._async_session
+    
+    async def apost(self, path: str, payload: dict, timeout: float = None, raise_for_status: bool = False) -> Tuple[int, dict]:
+        """Async version of post, returns the status code and the json response.
+        With raise_for_status, an error status raises aiohttp.ClientResponseError instead"""
+        session = self.get_async_session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with session.post(self.endpoint + path, data=json.dumps(payload), params=self.params,
+                                timeout=client_timeout, raise_for_status=raise_for_status) as resp:
+            return resp.status, await resp.json(content_type=None)
+    
+    async def asearch(self, index: str, search_payload: dict, timeout: float = None) -> dict:
+        """Async version of search"""
+        status, search_results = await self.apost("/indexes/" + index + "/docs/search", search_payload, timeout=timeout,
+                                                  raise_for_status=True)
+        return search_results
+    
+    async def aindex_documents(self, index: str, documents: List[dict], timeout: float = None) -> Tuple[int, dict]:
+        """Async version of index_documents"""
+        return await self.apost("/indexes/" + index + "/docs/index", {"value": documents}, timeout=timeout)
+    
+    def close(self):
+        self.session.close()
+    
+    async def aclose(self):
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+
+
+search_clients = dict()
+search_clients_lock = threading.Lock()
+
+def get_search_client() -> AzureSearchClient:
+    """Returns the process-wide AzureSearchClient for the current AZURE_SEARCH_* environment variables"""
+    config = (os.environ['AZURE_SEARCH_ENDPOINT'], os.environ['AZURE_SEARCH_KEY'], os.environ['AZURE_SEARCH_API_VERSION'])
+    with search_clients_lock:
+        if config not in search_clients:
+            search_clients[config] = AzureSearchClient(*config, pool_maxsize=SEARCH_MAX_WORKERS)
+        return search_clients[config]
+
+
+class SearchResultsCache:
+    """TTL cache for the results of get_search_results, bounded to max_entries (least recently used are evicted).
+    Keys are built from the normalized query and the search parameters. invalidate(index) drops every
+    entry that searched that index, and results of searches that were in flight during an invalidation are not stored."""
+    
+    def __init__(self, ttl: float = 300, max_entries: int = 1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expiration time, indexes, results)
+        self.generations = dict() # index -> number of invalidations
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(query: str, indexes: list, **params) -> str:
+        normalized_query = " ".join(query.lower().split())
+        if params.get("query_vector"):
+            params["query_vector"] = hashlib.sha256(array("f", params["query_vector"]).tobytes()).hexdigest()
+        return json.dumps([normalized_query, list(indexes), params], sort_keys=True)
+    
+    def generation(self, indexes: list) -> tuple:
+        with self.lock:
+            return tuple(self.generations.get(index, 0) for index in indexes)
+    
+    def get(self, key: str) -> Optional[OrderedDict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[2])
+    
+    def put(self, key: str, indexes: list, results: OrderedDict, generation: tuple):
+        with self.lock:
+            if generation != tuple(self.generations.get(index, 0) for index in indexes):
+                return # an index was updated while searching, the results may be stale
+            self.entries[key] = (time.monotonic() + self.ttl, list(indexes), copy.deepcopy(results))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, index: str):
+        """Drops the cached results of every search that included the index"""
+        with self.lock:
+            self.generations[index] = self.generations.get(index, 0) + 1
+            for key in [key for key, entry in self.entries.items() if index in entry[1]]:
+                del self.entries[key]
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+search_results_cache = SearchResultsCache(ttl=float(os.environ.get("SEARCH_CACHE_TTL", 300)),
+                                          max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 1000)))
+
+
+def build_search_payload(query: str, k: int = 5, vector_search: bool = False, query_vector: list = []) -> dict:
+    """Returns the semantic (and optionally vector) search payload sent to each index"""
+    search_payload = {
+        "search": query,
+        "queryType": "semantic",
+        "semanticConfiguration": "my-semantic-config",
+        "count": "true",
+        "speller": "lexicon",
+        "queryLanguage": "en-us",
+        "captions": "extractive",
+        "answers": "extractive",
+        "top": k
+    }
+    if vector_search:
+        search_payload["vectors"]= [{"value": query_vector, "fields": "chunkVector","k": k}]
+        search_payload["select"]= "id, title, chunk, name, location"
+    else:
+        search_payload["select"]= "id, title, chunks, name, location, vectorized"
+    return search_payload
 
-        resp = requests.post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + index + "/docs/search",
-                         data=json.dumps(search_payload), headers=headers, params=params)
 
-        search_results = resp.json()
-        agg_search_results[index] = search_results
+def merge_search_results(agg_search_results: dict, indexes: list,
+                         k: int = 5,
+                         reranker_threshold: int = 1,
+                         sas_token: str = "",
+                         vector_search: bool = False,
+                         similarity_k: int = 3) -> OrderedDict:
+    """Filters the per-index responses by reranker score and returns the top results ordered by score"""
+    
+    # Keep the indexes order so the merge does not depend on the arrival order
+    agg_search_results = {index: agg_search_results[index] for index in indexes if index in agg_search_results}
     
     content = dict()
     ordered_content = OrderedDict()
@@ -411,60 +996,509 @@ def get_search_results(query: str, indexes: list,
     return ordered_content
 
 
-def update_vector_indexes(ordered_search_results: dict, embedder: AzureOpenAIEmbeddings):
+def get_search_results(query: str, indexes: list, 
+                       k: int = 5,
+                       reranker_threshold: int = 1,
+                       sas_token: str = "",
+                       vector_search: bool = False,
+                       similarity_k: int = 3, 
+                       query_vector: list = [],
+                       parallel: bool = True,
+                       timeout: float = None,
+                       use_cache: bool = False) -> List[dict]:
     
-    """Get as input the results of a text-based multi-index search, vectorize the documents chunks that has not been done before and updates the vector-based indexes"""
+    """Searches the indexes and returns the results ordered by score.
+    If parallel=True the per-index queries are sent at the same time and merged as they arrive.
+    With a timeout (seconds), indexes that fail or do not answer in time are skipped and the partial results are returned.
+    With use_cache=True results are served from and stored in search_results_cache."""
     
-    headers = {'Content-Type': 'application/json','api-key': os.environ["AZURE_SEARCH_KEY"]}
-    params = {'api-version': os.environ['AZURE_SEARCH_API_VERSION']}
+    if use_cache:
+        cache_key = SearchResultsCache.make_key(query, indexes, k=k, reranker_threshold=reranker_threshold, sas_token=sas_token,
+                                                vector_search=vector_search, similarity_k=similarity_k, query_vector=query_vector)
+        cached_results = search_results_cache.get(cache_key)
+        if cached_results is not None:
+            return cached_results
+        cache_generation = search_results_cache.generation(indexes)
     
-    for key,value in ordered_search_results.items():
-        if value["vectorized"] != True: # If the document has not been vectorized yet
-            i = 0
-            for chunk in value["chunks"]: # Iterate over the text chunks
+    client = get_search_client()
+    search_payload = build_search_payload(query, k=k, vector_search=vector_search, query_vector=query_vector)
+
+    agg_search_results = dict()
+    
+    if parallel and len(indexes) > 1:
+        futures = {search_executor.submit(client.search, index, search_payload, timeout): index 
+                   for index in indexes}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                index = futures[future]
                 try:
-                    upload_payload = {  # Insert the chunk and its vector/embedding in the vector-based index
-                        "value": [
-                            {
-                                "id": key + "_" + str(i),
-                                "title": f"{value['title']}_chunk_{str(i)}",
-                                "chunk": chunk,
-                                "chunkVector": embedder.embed_query(chunk if chunk!="" else "-------"),
-                                "name": value["name"],
-                                "location": value["location"],
-                                "@search.action": "upload"
-                            },
-                        ]
-                    }
-
-                    r = requests.post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + value["index"]+"-vector" + "/docs/index",
-                                         data=json.dumps(upload_payload), headers=headers, params=params)
-                    if r.status_code != 200:
-                        print(r.status_code)
-                        print(r.text)
-                    else:
-                        i = i + 1 #increment chunk number
-                        
+                    agg_search_results[index] = future.result()
                 except Exception as e:
-                    print("Exception:",e)
-                    print(chunk)
-                    continue
+                    print("Search failed on index", index, ":", e)
+        except FuturesTimeoutError:
+            for future, index in futures.items():
+                if not future.done():
+                    future.cancel()
+                    print("Search timed out on index", index)
+    else:
+        for index in indexes:
+            try:
+                agg_search_results[index] = client.search(index, search_payload, timeout)
+            except requests.exceptions.Timeout:
+                print("Search timed out on index", index)
+            except requests.exceptions.RequestException as e:
+                print("Search failed on index", index, ":", e)
+    
+    ordered_content = merge_search_results(agg_search_results, indexes, k=k, reranker_threshold=reranker_threshold,
+                                           sas_token=sas_token, vector_search=vector_search, similarity_k=similarity_k)
 
-        # Update document in text-based index and mark it as "vectorized"
-        upload_payload = {
-            "value": [
-                {
-                    "id": key,
-                    "vectorized": True,
-                    "@search.action": "merge"
-                },
-            ]
-        }
+    if use_cache and len(agg_search_results) == len(indexes): # Partial results are not cached
+        search_results_cache.put(cache_key, indexes, ordered_content, cache_generation)
 
-        r = requests.post(os.environ['AZURE_SEARCH_ENDPOINT'] + "/indexes/" + value["index"]+ "/docs/index",
-                         data=json.dumps(upload_payload), headers=headers, params=params)
+    return ordered_content
 
 
+async def aget_search_results(query: str, indexes: list, 
+                              k: int = 5,
+                              reranker_threshold: int = 1,
+                              sas_token: str = "",
+                              vector_search: bool = False,
+                              similarity_k: int = 3, 
+                              query_vector: list = [],
+                              timeout: float = None,
+                              use_cache: bool = False) -> List[dict]:
+    
+    """Async version of get_search_results, the per-index queries run concurrently on the event loop"""
+    
+    if use_cache:
+        cache_key = SearchResultsCache.make_key(query, indexes, k=k, reranker_threshold=reranker_threshold, sas_token=sas_token,
+                                                vector_search=vector_search, similarity_k=similarity_k, query_vector=query_vector)
+        cached_results = search_results_cache.get(cache_key)
+        if cached_results is not None:
+            return cached_results
+        cache_generation = search_results_cache.generation(indexes)
+    
+    client = get_search_client()
+    search_payload = build_search_payload(query, k=k, vector_search=vector_search, query_vector=query_vector)
+    
+    responses = await asyncio.gather(*[asyncio.wait_for(client.asearch(index, search_payload), timeout) for index in indexes],
+                                     return_exceptions=True)
+    agg_search_results = dict()
+    for index, response in zip(indexes, responses):
+        if isinstance(response, Exception):
+            print("Search failed on index", index, ":", repr(response))
+        else:
+            agg_search_results[index] = response
+    
+    ordered_content = merge_search_results(agg_search_results, indexes, k=k, reranker_threshold=reranker_threshold,
+                                           sas_token=sas_token, vector_search=vector_search, similarity_k=similarity_k)
+
+    if use_cache and len(agg_search_results) == len(indexes): # Partial results are not cached
+        search_results_cache.put(cache_key, indexes, ordered_content, cache_generation)
+
+    return ordered_content
+
+
+def batch_documents(documents: List[dict], batch_size: int = 1000, max_batch_bytes: int = 8*1024*1024) -> List[List[dict]]:
+    """Splits document actions in batches of at most batch_size actions and max_batch_bytes of JSON
+    (the REST API rejects requests over 16MB, 1000 actions with embeddings go well over it)"""
+    batches = []
+    batch, batch_bytes = [], 0
+    for doc in documents:
+        doc_bytes = len(json.dumps(doc).encode("utf-8")) + 1
+        if batch and (len(batch) >= batch_size or batch_bytes + doc_bytes > max_batch_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += doc_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def index_documents_in_batches(index: str, documents: List[dict], batch_size: int = 1000, max_retries: int = 3,
+                               client: AzureSearchClient = None, max_batch_bytes: int = 8*1024*1024) -> List[str]:
+    """Sends document actions to an index in batches of up to batch_size actions and max_batch_bytes (see batch_documents).
+    The failed items of a response, and batches throttled as a whole (429/503), are retried together up to max_retries times,
+    right away the first time then with a backoff. Other batches that fail as a whole (too big, bad document, ...) are split
+    in halves until the culprit is isolated, instead of costing a request per item. Returns the keys of the items that could not be indexed."""
+    
+    client = client or get_search_client()
+    failed_keys = []
+    work = [(batch, 0) for batch in reversed(batch_documents(documents, batch_size, max_batch_bytes))] # (batch, attempt)
+    
+    while work:
+        batch, attempt = work.pop()
+        if attempt > 1:
+            sleep(2**(attempt - 2)) # Back off, most failures are throttling (503) or conflicts (409)
+        try:
+            r = client.index_documents(index, batch)
+            status, error = r.status_code, r.text
+        except Exception as e:
+            status, error = None, e
+        
+        if status in (200, 207): # 207: some of the items failed
+            failed_item_keys = set(item["key"] for item in r.json()["value"] if not item["status"])
+            retry = [doc for doc in batch if doc["id"] in failed_item_keys]
+        else:
+            print("Exception:", status, error)
+            retry = batch
+            if status not in (429, 503) and len(batch) > 1:
+                work += [(batch[len(batch)//2:], attempt), (batch[:len(batch)//2], attempt)]
+                continue
+        
+        if retry and attempt < max_retries:
+            work.append((retry, attempt + 1))
+        else:
+            for doc in retry:
+                print("Failed to index", doc["id"], "in", index)
+                failed_keys.append(doc["id"])
+    
+    search_results_cache.invalidate(index)
+    
+    return failed_keys
+
+
+def update_vector_indexes(ordered_search_results: dict, embedder: AzureOpenAIEmbeddings,
+                          embedding_batch_size: int = 16, index_batch_size: int = 1000):
+    
+    """Get as input the results of a text-based multi-index search, vectorize the documents chunks that has not been done before and updates the vector-based indexes.
+    Chunks are embedded with embed_documents in batches of embedding_batch_size and uploaded in batches of index_batch_size.
+    Returns the ids of the documents that could not be vectorized"""
+    
+    client = get_search_client()
+    
+    # Collect the chunks of the documents that have not been vectorized yet
+    pending_docs = []
+    pending_chunks = []
+    for key,value in ordered_search_results.items():
+        if value["vectorized"] != True: # If the document has not been vectorized yet
+            pending_docs.append(key)
+            for i, chunk in enumerate(value["chunks"]):
+                pending_chunks.append((key, i, chunk))
+    
+    # Embed the chunks in batches and build the upload actions per vector-based index
+    failed_docs = set()
+    upload_actions = dict()
+    for start in range(0, len(pending_chunks), embedding_batch_size):
+        batch = pending_chunks[start:start + embedding_batch_size]
+        try:
+            vectors = embedder.embed_documents([chunk if chunk!="" else "-------" for key, i, chunk in batch])
+        except Exception as e:
+            print("Exception:",e)
+            failed_docs.update(key for key, i, chunk in batch)
+            continue
+        
+        for (key, i, chunk), vector in zip(batch, vectors):
+            value = ordered_search_results[key]
+            upload_actions.setdefault(value["index"]+"-vector", []).append({  # Insert the chunk and its vector/embedding in the vector-based index
+                "id": key + "_" + str(i),
+                "title": f"{value['title']}_chunk_{str(i)}",
+                "chunk": chunk,
+                "chunkVector": vector,
+                "name": value["name"],
+                "location": value["location"],
+                "@search.action": "upload"
+            })
+    
+    for index, actions in upload_actions.items():
+        failed_keys = index_documents_in_batches(index, actions, batch_size=index_batch_size, client=client)
+        failed_docs.update(chunk_id.rsplit("_", 1)[0] for chunk_id in failed_keys)
+    
+    # Update documents in text-based indexes and mark them as "vectorized"
+    merge_actions = dict()
+    for key in pending_docs:
+        if key not in failed_docs:
+            merge_actions.setdefault(ordered_search_results[key]["index"], []).append({
+                "id": key,
+                "vectorized": True,
+                "@search.action": "merge"
+            })
+    
+    for index, actions in merge_actions.items():
+        failed_docs.update(index_documents_in_batches(index, actions, batch_size=index_batch_size, client=client))
+    
+    return [key for key in pending_docs if key in failed_docs]
+
+
+class VectorizationQueue:
+    """Background queue that vectorizes documents found by text-based searches (see update_vector_indexes).
+    Documents are deduplicated by id and processed by a bounded number of worker threads, so the
+    query path only submits them and returns. With persist_path, pending documents are persisted in a SQLite file and
+    re-queued when the process restarts. Vectorization is best-effort: errors are logged, never raised to the search."""
+    
+    def __init__(self, embedder: AzureOpenAIEmbeddings, max_workers: int = 2, persist_path: str = None,
+                 max_done_ids: int = 10000, db_timeout: float = 1.0):
+        self.embedder = embedder
+        self.max_done_ids = max_done_ids
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.pending = dict() # document id -> search result value
+        self.events = dict() # document id -> Event set when the document has been processed
+        self.done = OrderedDict() # recently vectorized ids, the text indexes take a moment to reflect the "vectorized" flag
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.completed_times = deque(maxlen=1000)
+        
+        self.db = None
+        self.db_lock = threading.Lock() # Disk I/O never holds self.lock
+        if persist_path:
+            try:
+                self.db = sqlite3.connect(persist_path, timeout=db_timeout, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, value TEXT)")
+                self.db.commit()
+                for key, value in self.db.execute("SELECT id, value FROM pending").fetchall():
+                    self._enqueue(key, json.loads(value))
+                    self.queue.put(key)
+            except sqlite3.Error as e:
+                print("Exception:",e)
+                self.db = None
+        
+        self.workers = [threading.Thread(target=self._worker, name=f"vectorizer-{i}", daemon=True) for i in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+    
+    def _enqueue(self, key: str, value: dict) -> Tuple[threading.Event, bool]:
+        # Must be called with self.lock held, except from __init__. Returns the event of the document and whether it is new
+        if key in self.events:
+            return self.events[key], False
+        self.pending[key] = value
+        self.events[key] = threading.Event()
+        return self.events[key], True
+    
+    def _persist(self, items: List[Tuple[str, dict]]):
+        if self.db is None or not items:
+            return
+        try:
+            with self.db_lock:
+                self.db.executemany("INSERT OR REPLACE INTO pending (id, value) VALUES (?, ?)",
+                                    [(key, json.dumps(value)) for key, value in items])
+                self.db.commit()
+        except sqlite3.Error as e: # Still queued in memory, only lost if the process restarts
+            print("Exception:",e)
+    
+    def _unpersist(self, key: str):
+        if self.db is None:
+            return
+        try:
+            with self.db_lock:
+                self.db.execute("DELETE FROM pending WHERE id = ?", (key,))
+                self.db.commit()
+        except sqlite3.Error as e: # Queued again on restart, vectorizing it twice is harmless
+            print("Exception:",e)
+    
+    def submit(self, ordered_search_results: dict, wait_ms: int = 0) -> bool:
+        """Queues the documents that have not been vectorized yet.
+        With wait_ms > 0 it waits up to that many milliseconds for them to be processed.
+        Returns True if all the submitted documents are already vectorized. Blocks on disk I/O with persistence,
+        use asyncio.to_thread from the event loop."""
+        try:
+            events, new = [], []
+            with self.lock:
+                for key, value in ordered_search_results.items():
+                    if value["vectorized"] != True and key not in self.done:
+                        event, is_new = self._enqueue(key, value)
+                        events.append(event)
+                        if is_new:
+                            new.append((key, value))
+            # Persisted before the workers can see them, so a processed document is never written back
+            self._persist(new)
+            for key, value in new:
+                self.queue.put(key)
+        except Exception as e:
+            print("Exception:",e)
+            return False
+        
+        deadline = time.monotonic() + wait_ms/1000
+        for event in events:
+            if not event.wait(timeout=max(0, deadline - time.monotonic())):
+                return False
+        return True
+    
+    def _worker(self):
+        while True:
+            key = self.queue.get()
+            try:
+                self._process(key)
+            except Exception as e: # The worker must survive anything, or the queue stops draining
+                print("Exception:",e)
+            finally:
+                self.queue.task_done()
+    
+    def _process(self, key: str):
+        with self.lock:
+            value = self.pending[key]
+            self.in_progress += 1
+        try:
+            failed = update_vector_indexes({key: value}, embedder=self.embedder)
+        except Exception as e:
+            print("Exception:",e)
+            failed = [key]
+        
+        with self.lock:
+            self.in_progress -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.completed_times.append(time.monotonic())
+                self.done[key] = True
+                if len(self.done) > self.max_done_ids:
+                    self.done.popitem(last=False)
+            # Failed documents are dropped from the queue, they will be submitted again by the next search that finds them
+            del self.pending[key]
+            self.events.pop(key).set()
+        self._unpersist(key)
+    
+    def metrics(self) -> dict:
+        """Returns queue depth and throughput counters"""
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "queue_depth": len(self.pending) - self.in_progress,
+                "in_progress": self.in_progress,
+                "completed": self.completed,
+                "failed": self.failed,
+                "completed_last_minute": sum(1 for t in self.completed_times if now - t <= 60),
+            }
+
+
+vectorization_queue = None
+vectorization_queue_lock = threading.Lock()
+
+def get_vectorization_queue(embedder: AzureOpenAIEmbeddings = None) -> VectorizationQueue:
+    """Returns the process-wide VectorizationQueue, creating it on first use.
+    Concurrency is set with VECTORIZATION_MAX_WORKERS, pending documents are only persisted when VECTORIZATION_QUEUE_PATH is set."""
+    global vectorization_queue
+    with vectorization_queue_lock:
+        if vectorization_queue is None:
+            vectorization_queue = VectorizationQueue(
+                embedder=embedder or get_embedder("text-embedding-ada-002"),
+                max_workers=int(os.environ.get("VECTORIZATION_MAX_WORKERS", 2)),
+                persist_path=os.environ.get("VECTORIZATION_QUEUE_PATH"))
+        return vectorization_queue
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Trims a text to at most max_tokens, cutting at the last sentence boundary. Returns "" if no sentence fits"""
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    truncated = get_encoding().decode(tokens[:max(max_tokens, 0)])
+    boundary = None
+    for boundary in re.finditer(r"[.!?](\s|$)", truncated):
+        pass
+    return truncated[:boundary.start()+1] if boundary else ""
+
+
+def pack_docs(docs: List[Document], tokens_budget: int) -> Tuple[List[Document], List[Document], List[Document]]:
+    """Greedily fills tokens_budget with Documents in score order (metadata["score"] if every doc has it, else the given order).
+    Each doc is counted as rendered by the stuff chain ("Content: ...\nSource: ..."). The first doc that does not fit
+    is trimmed at a sentence boundary to use the remaining budget.
+    Returns the packed docs, the dropped docs and the trimmed docs (their original versions)."""
+    
+    if all("score" in doc.metadata for doc in docs):
+        docs = sorted(docs, key=lambda doc: doc.metadata["score"], reverse=True)
+    
+    rendered = [f"Content: {doc.page_content}\nSource: {doc.metadata.get('source', '')}" for doc in docs]
+    separator_tokens = 2 # "\n\n" between the docs
+    
+    packed, dropped, trimmed = [], [], []
+    remaining = tokens_budget
+    for doc, doc_tokens in zip(docs, num_tokens_from_strings(rendered)):
+        if doc_tokens + separator_tokens <= remaining:
+            packed.append(doc)
+            remaining -= doc_tokens + separator_tokens
+        elif not trimmed and remaining > separator_tokens:
+            overhead = doc_tokens - num_tokens_from_string(doc.page_content)
+            content = trim_to_tokens(doc.page_content, remaining - separator_tokens - overhead)
+            if content:
+                packed.append(Document(page_content=content, metadata=dict(doc.metadata, trimmed=True)))
+                trimmed.append(doc)
+                remaining = 0
+            else:
+                dropped.append(doc)
+        else:
+            dropped.append(doc)
+    
+    return packed, dropped, trimmed
+
+
+class RateLimiter:
+    """Thread-safe sliding window limiter, allows at most max_calls per period (seconds)"""
+    
+    def __init__(self, max_calls: int, period: float = 60):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Blocks until a call is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                wait = self.period - (now - self.calls[0])
+            sleep(wait)
+
+
+# Shared by all the parallel LLM calls of this process
+llm_rate_limiter = RateLimiter(max_calls=int(os.environ.get("AZURE_OPENAI_MAX_CALLS_PER_MINUTE", 300)))
+
+# Map outputs that mean the document has nothing relevant to the question
+IRRELEVANT_MAP_OUTPUT = re.compile(r"^\W*(none|n/a|irrelevant|not relevant|no relevant (text|information)[^\n]*)\W*$", re.IGNORECASE)
+
+
+def map_reduce_answer(llm: AzureChatOpenAI,
+                      docs: List[Document],
+                      query: str,
+                      language: str,
+                      memory: ConversationBufferMemory = None,
+                      callback_manager: BaseCallbackManager = None,
+                      max_concurrency: int = 4,
+                      rate_limiter: RateLimiter = None,
+                      callbacks: Callbacks = None
+                     ) -> Dict[str, Any]:
+    
+    """Map reduce with the map calls (COMBINE_QUESTION_PROMPT) running concurrently, at most max_concurrency at a time
+    and throttled by rate_limiter. Documents whose map output is empty or irrelevant are skipped, the rest are combined
+    with a single stuff call, which is the only one that gets the run callbacks.
+    The answer includes "map_timings" (seconds per document) and "combine_time"."""
+    
+    rate_limiter = rate_limiter or llm_rate_limiter
+    map_chain = LLMChain(llm=llm, prompt=COMBINE_QUESTION_PROMPT, callback_manager=callback_manager)
+    
+    def map_doc(doc: Document) -> Tuple[str, float]:
+        rate_limiter.acquire()
+        start = time.perf_counter()
+        output = map_chain.run({"context": doc.page_content, "question": query, "language": language})
+        return output, time.perf_counter() - start
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(docs)))) as executor:
+        map_results = list(executor.map(map_doc, docs))
+    
+    summaries = []
+    map_timings = []
+    for doc, (output, elapsed) in zip(docs, map_results):
+        relevant = bool(output.strip()) and not IRRELEVANT_MAP_OUTPUT.match(output.strip())
+        if relevant:
+            summaries.append(Document(page_content=output, metadata=doc.metadata))
+        map_timings.append({"source": doc.metadata.get("source", ""), "seconds": elapsed, "relevant": relevant})
+    
+    start = time.perf_counter()
+    answer = get_answer(llm=llm, docs=summaries, query=query, language=language, chain_type="stuff",
+                        memory=memory, callback_manager=callback_manager, callbacks=callbacks)
+    answer["map_timings"] = map_timings
+    answer["combine_time"] = time.perf_counter() - start
+    
+    return answer
+
 
 def get_answer(llm: AzureChatOpenAI,
                docs: List[Document], 
@@ -472,50 +1506,254 @@ def get_answer(llm: AzureChatOpenAI,
                language: str, 
                chain_type: str,
                memory: ConversationBufferMemory = None,
-               callback_manager: BaseCallbackManager = None
+               callback_manager: BaseCallbackManager = None,
+               tokens_limit: int = None,
+               completion_tokens: int = None,
+               max_concurrency: int = 4,
+               callbacks: Callbacks = None
               ) -> Dict[str, Any]:
     
-    """Gets an answer to a question from a list of Documents."""
+    """Gets an answer to a question from a list of Documents.
+    chain_type="packed" runs a single stuff call on the docs that fit in the model context
+    (tokens_limit minus the prompt, chat history and completion_tokens), see pack_docs.
+    The answer then also has the "dropped_docs" and "trimmed_docs" keys.
+    chain_type="map_reduce" runs the map calls concurrently, see map_reduce_answer.
+    callbacks are passed down to the LLM of the run (e.g. to stream the answer tokens), unlike callback_manager."""
 
     # Get the answer
+    
+    if chain_type == "map_reduce":
+        return map_reduce_answer(llm=llm, docs=docs, query=query, language=language, memory=memory,
+                                 callback_manager=callback_manager, max_concurrency=max_concurrency, callbacks=callbacks)
+    
+    if chain_type == "packed":
+        prompt = COMBINE_PROMPT if memory == None else COMBINE_CHAT_PROMPT
+        tokens_limit = tokens_limit or model_tokens_limit(llm.deployment_name)
+        completion_tokens = completion_tokens or llm.max_tokens or 0
+        prompt_tokens = num_tokens_from_string(prompt.template + query + language)
+        if memory != None:
+            prompt_tokens += num_tokens_from_string(str(memory.load_memory_variables({}).get(memory.memory_key, "")))
+        
+        docs, dropped_docs, trimmed_docs = pack_docs(docs, tokens_limit - prompt_tokens - completion_tokens)
         
-    if chain_type == "stuff":
+    if chain_type == "stuff" or chain_type == "packed":
         if memory == None:
-            chain = load_qa_with_sources_chain(llm, chain_type=chain_type,
+            chain = load_qa_with_sources_chain(llm, chain_type="stuff",
                                                prompt=COMBINE_PROMPT,
                                                callback_manager=callback_manager)
         else:
-            chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
+            chain = load_qa_with_sources_chain(llm, chain_type="stuff", 
                                                prompt=COMBINE_CHAT_PROMPT,
                                                memory=memory,
                                                callback_manager=callback_manager)
 
-    elif chain_type == "map_reduce":
-        if memory == None:
-            chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
-                                               question_prompt=COMBINE_QUESTION_PROMPT,
-                                               combine_prompt=COMBINE_PROMPT,
-                                               callback_manager=callback_manager)
-        else:
-            chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
-                                               question_prompt=COMBINE_QUESTION_PROMPT,
-                                               combine_prompt=COMBINE_CHAT_PROMPT,
-                                               memory=memory,
-                                               callback_manager=callback_manager)
     else:
         print("Error: chain_type", chain_type, "not supported")
     
-    answer = chain( {"input_documents": docs, "question": query, "language": language}, return_only_outputs=True)
+    answer = chain( {"input_documents": docs, "question": query, "language": language}, return_only_outputs=True, callbacks=callbacks)
+    
+    if chain_type == "packed":
+        answer["dropped_docs"] = dropped_docs
+        answer["trimmed_docs"] = trimmed_docs
 
     return answer
 
 
-def run_agent(question:str, agent_chain: AgentExecutor) -> str:
+# Chat history stored one message per item, so only the last messages of a session are read
+class CosmosDBMessageStore:
+    """Chat messages in a CosmosDB container partitioned by /user_id (as created by CosmosDBChatMessageHistory.prepare_cosmos).
+    Sessions written by CosmosDBChatMessageHistory (one item with all the messages) are still read."""
+    
+    def __init__(self, container: Any, batch_size: int = 100):
+        self.container = container
+        self.batch_size = batch_size # CosmosDB transactional batches take at most 100 operations
+    
+    def read_last(self, session_id: str, user_id: str, k: int) -> List[dict]:
+        items = list(self.container.query_items(
+            query="SELECT TOP @k * FROM c WHERE c.session_id = @session_id AND IS_DEFINED(c.message) ORDER BY c.ts DESC",
+            parameters=[{"name": "@k", "value": k}, {"name": "@session_id", "value": session_id}],
+            partition_key=user_id))
+        messages = [item["message"] for item in reversed(items)]
+        if len(messages) < k:
+            try:
+                legacy = self.container.read_item(item=session_id, partition_key=user_id)
+                messages = legacy.get("messages", [])[-(k - len(messages)):] + messages
+            except Exception:
+                pass
+        return messages
+    
+    def write(self, items: List[dict]):
+        by_user = OrderedDict()
+        for item in items:
+            by_user.setdefault(item["user_id"], []).append(item)
+        for user_id, user_items in by_user.items():
+            for i in range(0, len(user_items), self.batch_size):
+                batch = user_items[i:i+self.batch_size]
+                if hasattr(self.container, "execute_item_batch"):
+                    self.container.execute_item_batch(batch_operations=[("upsert", (item,)) for item in batch], partition_key=user_id)
+                else:
+                    for item in batch:
+                        self.container.upsert_item(item)
+    
+    def delete_session(self, session_id: str, user_id: str):
+        items = self.container.query_items(
+            query="SELECT c.id FROM c WHERE c.session_id = @session_id OR c.id = @session_id",
+            parameters=[{"name": "@session_id", "value": session_id}],
+            partition_key=user_id)
+        for item in list(items):
+            self.container.delete_item(item=item["id"], partition_key=user_id)
+
+
+class SQLiteMessageStore:
+    """Same interface as CosmosDBMessageStore on a SQLite file (or in memory), for local runs and tests"""
+    
+    def __init__(self, path: str = ":memory:"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, session_id TEXT, user_id TEXT, ts INTEGER, message TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (user_id, session_id, ts)")
+        self.db.commit()
+    
+    def read_last(self, session_id: str, user_id: str, k: int) -> List[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT message FROM messages WHERE user_id = ? AND session_id = ? ORDER BY ts DESC LIMIT ?",
+                                   (user_id, session_id, k)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+    
+    def write(self, items: List[dict]):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO messages (id, session_id, user_id, ts, message) VALUES (?, ?, ?, ?, ?)",
+                                [(item["id"], item["session_id"], item["user_id"], item["ts"], json.dumps(item["message"])) for item in items])
+            self.db.commit()
+    
+    def delete_session(self, session_id: str, user_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+            self.db.commit()
+
+
+class WindowedChatHistoryStore:
+    """Keeps the last `window` messages of the hot sessions in memory (LRU of max_sessions) on top of a message store
+    (CosmosDBMessageStore, SQLiteMessageStore). A cold session costs one bounded query, new messages are written
+    behind in batches by a background thread every flush_interval seconds. Call close() on shutdown to flush."""
+    
+    def __init__(self, store: Any, window: int = 60, max_sessions: int = 1000, flush_interval: float = 1.0, batch_size: int = 500):
+        self.store = store
+        self.window = window
+        self.max_sessions = max_sessions
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock() # Held while a batch is being written, so a reload sees it either pending or stored
+        self.sessions = OrderedDict() # (user_id, session_id) -> deque of message dicts
+        self.pending = [] # items not written yet
+        self.last_ts = 0
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="chat-history-flush", daemon=True)
+        self.flusher.start()
+    
+    def get_history(self, session_id: str, user_id: str) -> "WindowedChatMessageHistory":
+        return WindowedChatMessageHistory(self, session_id, user_id)
+    
+    async def aload(self, session_id: str, user_id: str):
+        """Loads the session in a thread, so the memory of an async chain then reads it without blocking the event loop"""
+        await asyncio.to_thread(self._session, session_id, user_id)
+    
+    def _session(self, session_id: str, user_id: str) -> deque:
+        key = (user_id, session_id)
+        with self.lock:
+            if key in self.sessions:
+                self.sessions.move_to_end(key)
+                return self.sessions[key]
+        
+        # No flush runs between the read and the merge of the pending messages, or they could be read twice or missed
+        with self.flush_lock:
+            messages = deque(self.store.read_last(session_id, user_id, self.window), maxlen=self.window)
+            with self.lock:
+                if key in self.sessions: # Loaded by another thread in the meantime
+                    self.sessions.move_to_end(key)
+                    return self.sessions[key]
+                # Messages of an evicted session may not be written yet
+                for item in self.pending:
+                    if item["session_id"] == session_id and item["user_id"] == user_id:
+                        messages.append(item["message"])
+                self.sessions[key] = messages
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+                return messages
+    
+    def messages(self, session_id: str, user_id: str) -> List[BaseMessage]:
+        messages = self._session(session_id, user_id)
+        with self.lock:
+            return messages_from_dict(list(messages))
+    
+    def add_message(self, session_id: str, user_id: str, message: BaseMessage):
+        messages = self._session(session_id, user_id)
+        with self.lock:
+            self.last_ts = max(time.time_ns(), self.last_ts + 1)
+            item = {"id": f"{session_id}-{self.last_ts}", "session_id": session_id, "user_id": user_id,
+                    "ts": self.last_ts, "message": message_to_dict(message)}
+            messages.append(item["message"])
+            self.pending.append(item)
+    
+    def clear(self, session_id: str, user_id: str):
+        with self.flush_lock: # A flush in progress removes its batch from the start of pending
+            with self.lock:
+                self.sessions.pop((user_id, session_id), None)
+                self.pending = [item for item in self.pending if not (item["session_id"] == session_id and item["user_id"] == user_id)]
+            self.store.delete_session(session_id, user_id)
+    
+    def flush(self):
+        """Writes the pending messages, in batches of batch_size"""
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = self.pending[:self.batch_size]
+                if not batch:
+                    return
+                try:
+                    self.store.write(batch)
+                except Exception as e:
+                    print("Exception:",e)
+                    return # Kept pending, retried on the next flush
+                with self.lock:
+                    del self.pending[:len(batch)]
+    
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+    
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """Chat history of one session, backed by a WindowedChatHistoryStore"""
+    
+    def __init__(self, store: WindowedChatHistoryStore, session_id: str, user_id: str):
+        self.store = store
+        self.session_id = session_id
+        self.user_id = user_id
+    
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.messages(self.session_id, self.user_id)
+    
+    def add_message(self, message: BaseMessage) -> None:
+        self.store.add_message(self.session_id, self.user_id, message)
+    
+    def clear(self) -> None:
+        self.store.clear(self.session_id, self.user_id)
+
+
+def run_agent(question:str, agent_chain: AgentExecutor, callbacks: Callbacks = None) -> str:
     """Function to run the brain agent and deal with potential parsing errors"""
     
     for i in range(5):
         try:
-            response = agent_chain.run(input=question)
+            response = agent_chain.run(input=question, callbacks=callbacks)
             break
         except OutputParserException as e:
             # If the agent has a parsing error, we use OpenAI model again to reformat the error and give a good answer
@@ -529,8 +1767,43 @@ def run_agent(question:str, agent_chain: AgentExecutor) -> str:
             continue
     
     return response
+
+
+async def arun_agent(question:str, agent_chain: AgentExecutor, callbacks: Callbacks = None) -> str:
+    """Async version of run_agent"""
+    
+    for i in range(5):
+        try:
+            response = await agent_chain.arun(input=question, callbacks=callbacks)
+            break
+        except OutputParserException as e:
+            # If the agent has a parsing error, we use OpenAI model again to reformat the error and give a good answer
+            chatgpt_chain = LLMChain(
+                    llm=agent_chain.agent.llm_chain.llm, 
+                        prompt=PromptTemplate(input_variables=["error"],template='Remove any json formating from the below text, also remove any portion that says someting similar this "Could not parse LLM output: ". Reformat your response in beautiful Markdown. Just give me the reformated text, nothing else.\n Text: {error}'), 
+                    verbose=False
+                )
+
+            response = await chatgpt_chain.arun(str(e))
+            continue
+    
+    return response
     
 
+def get_child_callbacks(tool: BaseTool, run_manager: Optional[Union[CallbackManagerForToolRun, AsyncCallbackManagerForToolRun]] = None) -> Optional[BaseCallbackManager]:
+    """Returns the callbacks for the chains and agents run inside a tool: the inheritable callbacks
+    of the current run (e.g. passed to AgentExecutor.run) plus the callbacks the tool was created with.
+    Pass them when running the inner chain (callbacks=), a callback_manager given when building it does not reach its LLM and tools"""
+    if run_manager is None:
+        return tool.callbacks
+    callbacks = run_manager.get_child()
+    own_handlers = tool.callbacks.handlers if isinstance(tool.callbacks, BaseCallbackManager) else (tool.callbacks or [])
+    for handler in own_handlers:
+        if handler not in callbacks.handlers:
+            callbacks.add_handler(handler)
+    return callbacks
+
+
 ######## AGENTS AND TOOL CLASSES #####################################
 ###########################################################
     
@@ -547,19 +1820,10 @@ class GetDocSearchResults_Tool(BaseTool):
     similarity_k: int = 3
     sas_token: str = "" 
     embedding_model: str = "text-embedding-ada-002"
+    vectorization_wait_ms: int = 0
     
-    def _run(self, query: str) -> str:
-        
-        embedder = AzureOpenAIEmbeddings(model="text-embedding-ada-002", skip_empty=True) 
-    
+    def _get_vector_indexes(self) -> List[str]:
         if self.indexes:
-            # Search in text-based indexes first and update corresponding vector indexes
-            ordered_results = get_search_results(query, indexes=self.indexes, k=self.k, 
-                                                    reranker_threshold=self.reranker_th,
-                                                    vector_search=False)
-            
-            update_vector_indexes(ordered_search_results=ordered_results, embedder=embedder)
-            
             vector_indexes = [index+"-vector" for index in self.indexes]
             if self.vector_only_indexes:
                 vector_indexes = vector_indexes + self.vector_only_indexes
@@ -569,9 +1833,23 @@ class GetDocSearchResults_Tool(BaseTool):
 
         if self.verbose:
             print("Vector Indexes:",vector_indexes)
+        
+        return vector_indexes
+    
+    def _run(self, query: str) -> str:
+        
+        embedder = get_embedder(self.embedding_model)
+    
+        if self.indexes:
+            # Search in text-based indexes first and queue the vectorization of the new documents found
+            ordered_results = get_search_results(query, indexes=self.indexes, k=self.k, 
+                                                    reranker_threshold=self.reranker_th,
+                                                    vector_search=False)
+            
+            get_vectorization_queue(embedder).submit(ordered_results, wait_ms=self.vectorization_wait_ms)
 
         # Search in all vector-based indexes available
-        ordered_results = get_search_results(query, indexes=vector_indexes, k=self.k,
+        ordered_results = get_search_results(query, indexes=self._get_vector_indexes(), k=self.k,
                                              reranker_threshold=self.reranker_th,
                                              vector_search=True,
                                              similarity_k=self.similarity_k,
@@ -583,7 +1861,33 @@ class GetDocSearchResults_Tool(BaseTool):
 
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("DocSearchResults does not support async")
+        
+        embedder = get_embedder(self.embedding_model)
+        query_vector = asyncio.ensure_future(embedder.aembed_query(query)) # Embed the query while the text search runs
+    
+        if self.indexes:
+            try:
+                # Search in text-based indexes first and queue the vectorization of the new documents found
+                ordered_results = await aget_search_results(query, indexes=self.indexes, k=self.k, 
+                                                               reranker_threshold=self.reranker_th,
+                                                               vector_search=False)
+                
+                # Creating the queue and submitting may touch its SQLite file and waits up to vectorization_wait_ms, off the event loop
+                await asyncio.to_thread(lambda: get_vectorization_queue(embedder).submit(ordered_results, self.vectorization_wait_ms))
+            except BaseException:
+                query_vector.cancel() # Nobody awaits the embedding anymore
+                raise
+
+        # Search in all vector-based indexes available
+        ordered_results = await aget_search_results(query, indexes=self._get_vector_indexes(), k=self.k,
+                                                    reranker_threshold=self.reranker_th,
+                                                    vector_search=True,
+                                                    similarity_k=self.similarity_k,
+                                                    query_vector = await query_vector,
+                                                    sas_token=self.sas_token,
+                                                   )
+        
+        return ordered_results
   
 
 class DocSearchAgent(BaseTool):
@@ -600,26 +1904,31 @@ class DocSearchAgent(BaseTool):
     similarity_k: int = 3
     sas_token: str = ""   
     embedding_model: str = "text-embedding-ada-002"
+    vectorization_wait_ms: int = 0
+    
+    def _get_agent_executor(self) -> AgentExecutor:
+        tools = [GetDocSearchResults_Tool(indexes=self.indexes,vector_only_indexes=self.vector_only_indexes,
+                                  k=self.k, reranker_th=self.reranker_th, similarity_k=self.similarity_k,
+                                  sas_token=self.sas_token, embedding_model=self.embedding_model,
+                                  vectorization_wait_ms=self.vectorization_wait_ms)]
+        
+        return initialize_agent(tools=tools, 
+                                llm=self.llm, 
+                                agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+                                agent_kwargs={'prefix':DOCSEARCH_PROMPT_PREFIX},
+                                verbose=self.verbose,
+                                handle_parsing_errors=True)
     
-    def _run(self, tool_input: Union[str, Dict],) -> str:
+    def _run(self, tool_input: Union[str, Dict], run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         try:
-            tools = [GetDocSearchResults_Tool(indexes=self.indexes,vector_only_indexes=self.vector_only_indexes,
-                                      k=self.k, reranker_th=self.reranker_th, similarity_k=self.similarity_k,
-                                      sas_token=self.sas_token, embedding_model=self.embedding_model)]
-            
             parsed_input = self._parse_input(tool_input)
             
-            agent_executor = initialize_agent(tools=tools, 
-                                              llm=self.llm, 
-                                              agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
-                                              agent_kwargs={'prefix':DOCSEARCH_PROMPT_PREFIX},
-                                              callback_manager=self.callbacks,
-                                              verbose=self.verbose,
-                                              handle_parsing_errors=True)
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
             
             for i in range(2):
                 try:
-                    response = run_agent(parsed_input, agent_executor)
+                    response = run_agent(parsed_input, agent_executor, callbacks=callbacks)
                     break
                 except Exception as e:
                     response = str(e)
@@ -630,28 +1939,228 @@ class DocSearchAgent(BaseTool):
         except Exception as e:
             print(e)
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, tool_input: Union[str, Dict], run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("DocSearchTool does not support async")
+        try:
+            parsed_input = self._parse_input(tool_input)
+            
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
+            
+            for i in range(2):
+                try:
+                    response = await arun_agent(parsed_input, agent_executor, callbacks=callbacks)
+                    break
+                except Exception as e:
+                    response = str(e)
+                    continue
+
+            return response
+        
+        except Exception as e:
+            print(e)
+    
+    
+
+# Tabular files: DataFrames cached by path and modification time, big CSVs converted once to Parquet
+dataframe_cache = OrderedDict()
+dataframe_cache_lock = threading.Lock()
+csv_agents = OrderedDict()
+
+def file_version(path: str) -> Tuple[str, Optional[int], Optional[int]]:
+    """(absolute path, mtime, size) of a local file. Other paths pandas can read (URLs, ...) have no version,
+    they are keyed on the path alone and read again only once evicted from the cache"""
+    if not os.path.isfile(path):
+        return (path, None, None)
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def csv_to_parquet(path: str, dtype: dict = None, parquet_dir: str = None) -> Optional[str]:
+    """Converts the CSV to a Parquet file next to the other cached ones, once per version of the CSV and dtype.
+    Returns None if pyarrow is not installed."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    
+    parquet_dir = parquet_dir or os.environ.get("CSV_PARQUET_DIR", os.path.join(tempfile.gettempdir(), "csv_parquet"))
+    version = file_version(path)
+    parquet_path = os.path.join(parquet_dir, hashlib.sha256(str((version, str(dtype))).encode()).hexdigest()[:32] + ".parquet")
+    if not os.path.exists(parquet_path):
+        os.makedirs(parquet_dir, exist_ok=True)
+        df = pd.read_csv(path, dtype=dtype)
+        tmp_path = parquet_path + f".{os.getpid()}.tmp"
+        # The dtypes found when parsing the CSV are kept in the Parquet schema, reloading does not infer them again
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+
+def load_dataframe(path: str, dtype: dict = None, parquet_min_mb: float = None, max_entries: int = None) -> pd.DataFrame:
+    """Returns the DataFrame of a CSV (or Parquet) file, parsed once per version of the file (path, mtime and size).
+    CSVs of parquet_min_mb MB or more (CSV_PARQUET_MIN_MB, 50 by default, negative to disable) are converted once
+    to Parquet and loaded memory-mapped. At most max_entries (CSV_CACHE_MAX_ENTRIES) DataFrames are kept."""
+    parquet_min_mb = parquet_min_mb if parquet_min_mb is not None else float(os.environ.get("CSV_PARQUET_MIN_MB", 50))
+    max_entries = max_entries or int(os.environ.get("CSV_CACHE_MAX_ENTRIES", 8))
+    key = (file_version(path), str(dtype))
+    
+    with dataframe_cache_lock:
+        if key in dataframe_cache:
+            dataframe_cache.move_to_end(key)
+            return dataframe_cache[key]
+    
+    if path.lower().endswith(".parquet"):
+        df = pd.read_parquet(path, memory_map=True)
+    else:
+        parquet_path = None
+        if parquet_min_mb >= 0 and key[0][2] is not None and key[0][2] >= parquet_min_mb * 1024 * 1024:
+            parquet_path = csv_to_parquet(path, dtype=dtype)
+        if parquet_path:
+            df = pd.read_parquet(parquet_path, memory_map=True)
+        else:
+            df = pd.read_csv(path, dtype=dtype)
+    
+    with dataframe_cache_lock:
+        dataframe_cache[key] = df
+        while len(dataframe_cache) > max_entries:
+            dataframe_cache.popitem(last=False)
+    return df
+
+
+def get_csv_agent(llm: AzureChatOpenAI, path: str, verbose: bool = False, dtype: dict = None) -> AgentExecutor:
+    """Pandas agent on the cached DataFrame of the file, reused while the file does not change.
+    The callbacks of each question are passed when running it."""
+    df = load_dataframe(path, dtype=dtype)
+    key = (id(llm), file_version(path), str(dtype), verbose)
+    with dataframe_cache_lock:
+        if key in csv_agents and csv_agents[key][0] is llm:
+            csv_agents.move_to_end(key)
+            return csv_agents[key][1]
+    
+    # The agent gets its own (shallow) copy, columns it adds do not end up in the cached DataFrame
+    agent = create_pandas_dataframe_agent(llm, df.copy(deep=False), verbose=verbose,
+                                          agent_executor_kwargs={"handle_parsing_errors": True})
+    with dataframe_cache_lock:
+        csv_agents[key] = (llm, agent)
+        while len(csv_agents) > len(dataframe_cache) + 1:
+            csv_agents.popitem(last=False)
+    return agent
+
+
+# DuckDB views over the tabular files, queried with SQL out-of-core and on all the cores
+duckdb_databases = OrderedDict()
+
+def duckdb_view_name(path: str) -> str:
+    name = re.sub(r"\W+", "_", os.path.splitext(os.path.basename(path))[0]).strip("_").lower() or "data"
+    return name if not name[0].isdigit() else "t_" + name
+
+
+def remove_duckdb_database(db: "CachedSQLDatabase"):
+    """Closes the connections of a DuckDB database created by get_duckdb_database and deletes its file"""
+    db._engine.dispose()
+    for path in (db._engine.url.database, db._engine.url.database + ".wal"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@atexit.register
+def remove_duckdb_databases():
+    with dataframe_cache_lock:
+        while duckdb_databases:
+            remove_duckdb_database(duckdb_databases.popitem()[1])
+
+
+def get_duckdb_database(paths: List[str], threads: int = None, memory_limit: str = None, dtype: dict = None) -> "CachedSQLDatabase":
+    """SQL database with one DuckDB view per CSV/Parquet file (named after the file), created once per version of the files.
+    Local CSVs are converted once to Parquet (see csv_to_parquet) so queries do not parse them again, the views read
+    the other files directly. The database files are deleted when evicted and on exit.
+    Threads and memory limit are set with DUCKDB_THREADS and DUCKDB_MEMORY_LIMIT, bigger than memory queries spill to disk."""
+    try:
+        import duckdb_engine # Registers the duckdb dialect in SQLAlchemy
+    except ImportError:
+        raise ImportError("duckdb and duckdb-engine are needed to query tabular files with SQL, "
+                          "please install them with `pip install duckdb duckdb-engine`")
+    
+    versions = tuple(file_version(path) for path in paths)
+    key = (versions, str(dtype))
+    with dataframe_cache_lock:
+        if key in duckdb_databases:
+            duckdb_databases.move_to_end(key)
+            return duckdb_databases[key]
+    
+    duckdb_dir = os.path.join(tempfile.gettempdir(), "duckdb")
+    os.makedirs(duckdb_dir, exist_ok=True)
+    db_path = os.path.join(duckdb_dir, f"{os.getpid()}-{hashlib.sha256(str(key).encode()).hexdigest()[:16]}.duckdb")
+    config = {"threads": threads or int(os.environ.get("DUCKDB_THREADS", os.cpu_count() or 1)),
+              "temp_directory": duckdb_dir}
+    memory_limit = memory_limit or os.environ.get("DUCKDB_MEMORY_LIMIT")
+    if memory_limit:
+        config["memory_limit"] = memory_limit
+    engine = create_engine(f"duckdb:///{db_path}", connect_args={"config": config})
     
+    with engine.begin() as connection:
+        for path, version in zip(paths, versions):
+            source = version[0]
+            if path.lower().endswith(".parquet"):
+                reader = "read_parquet"
+            else:
+                parquet_path = csv_to_parquet(path, dtype=dtype) if version[1] is not None else None
+                reader, source = ("read_parquet", parquet_path) if parquet_path else ("read_csv_auto", source)
+            source = source.replace("'", "''")
+            connection.execute(text(f'CREATE OR REPLACE VIEW "{duckdb_view_name(path)}" AS SELECT * FROM {reader}(\'{source}\')'))
     
+    db = CachedSQLDatabase(engine, view_support=True,
+                           max_rows=int(os.environ.get("SQL_MAX_ROWS", 100)),
+                           max_bytes=int(os.environ.get("SQL_MAX_BYTES", 20000)))
+    with dataframe_cache_lock:
+        duckdb_databases[key] = db
+        while len(duckdb_databases) > int(os.environ.get("CSV_CACHE_MAX_ENTRIES", 8)):
+            remove_duckdb_database(duckdb_databases.popitem(last=False)[1])
+    return db
+
 
 class CSVTabularAgent(BaseTool):
-    """Agent to interact with CSV files"""
+    """Agent to interact with CSV files.
+    mode="pandas" loads the file in a DataFrame and answers with a python agent,
+    mode="duckdb" answers with a SQL agent over a DuckDB view of the file (CSV or Parquet), which does not keep it in memory."""
     
     name = "@csvfile"
     description = "useful when the questions includes the term: @csvfile.\n"
 
     path: str
     llm: AzureChatOpenAI
+    dtype: Optional[dict] = None
+    mode: str = "pandas"
+    k: int = 30
     
-    def _run(self, query: str) -> str:
+    def _get_agent(self) -> AgentExecutor:
+        if self.mode == "duckdb":
+            db = get_duckdb_database([self.path], dtype=self.dtype)
+            return create_sql_agent(
+                prefix=MSSQL_AGENT_PREFIX,
+                format_instructions = DUCKDB_AGENT_FORMAT_INSTRUCTIONS,
+                llm=self.llm,
+                toolkit=SQLDatabaseToolkit(db=db, llm=self.llm),
+                top_k=self.k,
+                verbose=self.verbose,
+                agent_executor_kwargs={"handle_parsing_errors": True}
+            )
+        return get_csv_agent(self.llm, self.path, verbose=self.verbose, dtype=self.dtype)
+    
+    def _get_input(self, query: str) -> str:
+        return query if self.mode == "duckdb" else CSV_PROMPT_PREFIX + query + CSV_PROMPT_SUFFIX
+    
+    def _run(self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         
         try:
-            agent = create_csv_agent(self.llm, self.path, verbose=self.verbose, callback_manager=self.callbacks, handle_parsing_errors=True)
+            agent = self._get_agent()
             for i in range(5):
                 try:
-                    response = agent.run(CSV_PROMPT_PREFIX + query + CSV_PROMPT_SUFFIX) 
+                    response = agent.run(self._get_input(query), callbacks=get_child_callbacks(self, run_manager)) 
                     break
                 except:
                     response = "Error too many failed retries"
@@ -663,11 +2172,295 @@ class CSVTabularAgent(BaseTool):
             response = e
             return response
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("CSVTabularTool does not support async")
         
+        try:
+            # Loading the file (when not cached) is blocking, the agent itself runs on the event loop
+            agent = await asyncio.to_thread(self._get_agent)
+            for i in range(5):
+                try:
+                    response = await agent.arun(self._get_input(query), callbacks=get_child_callbacks(self, run_manager)) 
+                    break
+                except:
+                    response = "Error too many failed retries"
+                    continue
+
+            return response
+        except Exception as e:
+            print(e)
+            response = e
+            return response
+
+
+def benchmark_tabular_agents(llm: AzureChatOpenAI, path: str, questions: List[str], modes: List[str] = ["pandas", "duckdb"], runs: int = 1) -> pd.DataFrame:
+    """Compares the modes of CSVTabularAgent on a file: seconds to load it (caches cleared first) and to answer each question"""
+    results = []
+    for mode in modes:
+        with dataframe_cache_lock:
+            dataframe_cache.clear()
+            csv_agents.clear()
+            duckdb_databases.clear()
+        tool = CSVTabularAgent(path=path, llm=llm, mode=mode)
+        
+        start = time.perf_counter()
+        tool._get_agent()
+        load_seconds = time.perf_counter() - start
+        
+        for question in questions:
+            for run in range(runs):
+                start = time.perf_counter()
+                answer = tool.run(question)
+                results.append({"mode": mode, "question": question, "run": run, "load_seconds": load_seconds,
+                                "answer_seconds": time.perf_counter() - start, "answer": answer})
+    return pd.DataFrame(results)
+        
+        
+# SQL: one pooled engine per database, schema reflected once and refreshed every SQL_SCHEMA_REFRESH_SECONDS
+def get_sql_url() -> URL:
+    db_config = {
+        'drivername': 'mssql+pyodbc',
+        'username': os.environ["SQL_SERVER_USERNAME"] +'@'+ os.environ["SQL_SERVER_NAME"],
+        'password': os.environ["SQL_SERVER_PASSWORD"],
+        'host': os.environ["SQL_SERVER_NAME"],
+        'port': 1433,
+        'database': os.environ["SQL_SERVER_DATABASE"],
+        'query': {'driver': 'ODBC Driver 17 for SQL Server'}
+    }
+    return URL.create(**db_config)
+
+
+sql_engines = dict()
+sql_databases = dict()
+sql_toolkits = dict()
+sql_lock = threading.Lock()
+
+def get_sql_engine(db_url: URL = None) -> Engine:
+    """Returns the process-wide engine of the database, its pool is set with SQL_POOL_SIZE, SQL_POOL_MAX_OVERFLOW
+    and SQL_POOL_RECYCLE. Connections are checked before use (pool_pre_ping), idle ones can be dropped by Azure SQL."""
+    db_url = db_url or get_sql_url()
+    with sql_lock:
+        key = str(db_url)
+        if key not in sql_engines:
+            engine_args = dict(pool_pre_ping=True, pool_recycle=int(os.environ.get("SQL_POOL_RECYCLE", 1800)))
+            if db_url.get_backend_name() != "sqlite":
+                engine_args.update(pool_size=int(os.environ.get("SQL_POOL_SIZE", 5)),
+                                   max_overflow=int(os.environ.get("SQL_POOL_MAX_OVERFLOW", 10)))
+            sql_engines[key] = create_engine(db_url, **engine_args)
+        return sql_engines[key]
+
+
+# Adds a row limit to a plain SELECT that has none, TOP for SQL Server and LIMIT for the others
+def add_row_limit(command: str, limit: int, dialect: str = "mssql") -> str:
+    statement = command.strip().rstrip(";")
+    if ";" in statement or not re.match(r"^\s*SELECT\b", statement, re.IGNORECASE) or re.search(r"\bUNION\b|\bINTO\b", statement, re.IGNORECASE):
+        return command
+    if dialect == "mssql":
+        if re.search(r"\bTOP\b|\bOFFSET\b", statement, re.IGNORECASE):
+            return command
+        return re.sub(r"^\s*SELECT(\s+DISTINCT)?\b", lambda m: f"SELECT{m.group(1) or ''} TOP ({limit})", statement, count=1, flags=re.IGNORECASE)
+    if re.search(r"\bLIMIT\b|\bFETCH\b", statement, re.IGNORECASE):
+        return command
+    return f"{statement}\nLIMIT {limit}" # On its own line, so a trailing -- comment cannot swallow it
+
+
+def summarize_rows(columns: List[str], rows: List[tuple], max_string_length: int = 300) -> str:
+    """Per column stats of the rows: min/max/mean of numbers, distinct values and nulls of the rest"""
+    stats = []
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows if row[i] is not None]
+        nulls = len(rows) - len(values)
+        numbers = [v for v in values if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)] # DECIMAL/NUMERIC columns come as Decimal
+        if values and len(numbers) == len(values):
+            stats.append(f"{column}: min {min(numbers)}, max {max(numbers)}, mean {round(sum(map(float, numbers))/len(numbers), 4)}, nulls {nulls}")
+        else:
+            distinct = list(dict.fromkeys(str(v) for v in values))
+            examples = ", ".join(truncate_word(v, length=50) for v in distinct[:5])
+            stats.append(f"{column}: {len(distinct)} distinct values (e.g. {examples}), nulls {nulls}")
+    return truncate_word("\n".join(stats), length=max_string_length * len(columns))
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase that builds the info of each table (CREATE TABLE and sample rows) only once.
+    Query results are read in batches up to max_rows rows / max_bytes characters, plain SELECTs get a row limit added,
+    a result over the budget is returned as a preview plus column stats instead of all its rows."""
+    
+    def __init__(self, engine: Engine, max_rows: int = 100, max_bytes: int = 20000, preview_rows: int = 10, **kwargs: Any):
+        super().__init__(engine, **kwargs)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.preview_rows = preview_rows
+        self.created_at = time.monotonic()
+        self._table_info = dict()
+        self._table_info_lock = threading.Lock()
+    
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        all_table_names = self.get_usable_table_names()
+        if table_names is not None:
+            missing_tables = set(table_names).difference(all_table_names)
+            if missing_tables:
+                raise ValueError(f"table_names {missing_tables} not found in database")
+            all_table_names = table_names
+        
+        tables = []
+        for table_name in all_table_names:
+            with self._table_info_lock:
+                table_info = self._table_info.get(table_name)
+            if table_info is None:
+                table_info = super().get_table_info([table_name])
+                with self._table_info_lock:
+                    self._table_info[table_name] = table_info
+            if table_info:
+                tables.append(table_info)
+        tables.sort()
+        return "\n\n".join(tables)
+    
+    def run(self, command: str, fetch: str = "all") -> str:
+        if fetch != "all":
+            return super().run(command, fetch)
+        
+        command = add_row_limit(command, self.max_rows + 1, self.dialect)
+        rows = []
+        size = 2
+        over_budget = False
+        first_row = None
+        with self._engine.begin() as connection:
+            cursor = connection.execution_options(stream_results=True).execute(text(command))
+            if not cursor.returns_rows:
+                return ""
+            columns = list(cursor.keys())
+            while not over_budget:
+                batch = cursor.fetchmany(50)
+                if not batch:
+                    break
+                for row in batch:
+                    row = tuple(truncate_word(c, length=self._max_string_length) for c in row)
+                    first_row = first_row or row
+                    size += len(str(row)) + 2
+                    if len(rows) >= self.max_rows or size > self.max_bytes:
+                        over_budget = True
+                        break
+                    rows.append(row)
+            cursor.close()
         
+        if not over_budget:
+            return str(rows) if rows else ""
+        if not rows: # Not even the first row fits, an empty string would read as "no results"
+            return (f"The query returned rows, but the first one alone is over the {self.max_bytes} characters budget. "
+                    f"Select fewer or shorter columns.\n"
+                    f"Columns: {', '.join(columns)}\n"
+                    f"First row (truncated): {truncate_word(str(first_row), length=self.max_bytes // 2)}")
+        
+        return (f"The query returned more than {len(rows)} rows, only the first {min(self.preview_rows, len(rows))} are shown. "
+                f"Aggregate or filter the query if you need all of them.\n"
+                f"Columns: {', '.join(columns)}\n"
+                f"First rows: {str(rows[:self.preview_rows])}\n"
+                f"Stats of the first {len(rows)} rows:\n{summarize_rows(columns, rows)}")
+
+
+def get_sql_database(db_url: URL = None, refresh_seconds: int = None) -> CachedSQLDatabase:
+    """Returns the CachedSQLDatabase of the database, reflected again once it is older than
+    refresh_seconds (SQL_SCHEMA_REFRESH_SECONDS, 1 hour by default)"""
+    db_url = db_url or get_sql_url()
+    refresh_seconds = refresh_seconds if refresh_seconds is not None else int(os.environ.get("SQL_SCHEMA_REFRESH_SECONDS", 3600))
+    key = str(db_url)
+    with sql_lock:
+        db = sql_databases.get(key)
+    if db is None or time.monotonic() - db.created_at > refresh_seconds:
+        db = CachedSQLDatabase(get_sql_engine(db_url),
+                               max_rows=int(os.environ.get("SQL_MAX_ROWS", 100)),
+                               max_bytes=int(os.environ.get("SQL_MAX_BYTES", 20000)))
+        with sql_lock:
+            sql_databases[key] = db
+    return db
+
+
+# Words of identifiers and values: "covidTracking_2020" -> ["covid", "tracking", "2020"], plurals are folded
+def tokenize_for_ranking(text: str) -> List[str]:
+    words = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", str(text))
+    return [word.lower()[:-1] if len(word) > 3 and word.lower().endswith("s") else word.lower() for word in words]
+
+
+class SQLSchemaIndex:
+    """Compact description of each table (columns, types and a few sample values) and a lexical ranker
+    (BM25 over the table name, column names and sample values) to pick the tables related to a question"""
+    
+    def __init__(self, db: SQLDatabase, sample_values: int = 3, max_value_length: int = 30):
+        self.descriptions = dict()
+        self.terms = dict()
+        
+        usable_tables = set(db.get_usable_table_names())
+        for table in db._metadata.sorted_tables:
+            if table.name not in usable_tables:
+                continue
+            try:
+                with db._engine.connect() as connection:
+                    rows = connection.execute(select(table).limit(sample_values)).fetchall()
+            except Exception as e:
+                print("Exception:",e)
+                rows = []
+            
+            columns = []
+            terms = Counter()
+            terms.update(tokenize_for_ranking(table.name) * 3)
+            for i, column in enumerate(table.columns):
+                values = list(dict.fromkeys(str(row[i])[:max_value_length] for row in rows if row[i] is not None))
+                column_type = str(column.type) if not isinstance(column.type, NullType) else "?"
+                columns.append(f"{column.name} {column_type}" + (f" (e.g. {', '.join(values)})" if values else ""))
+                terms.update(tokenize_for_ranking(column.name) * 2)
+                for value in values:
+                    terms.update(tokenize_for_ranking(value))
+            
+            self.descriptions[table.name] = f"{table.name}: " + "; ".join(columns)
+            self.terms[table.name] = terms
+        
+        self.avg_length = sum(sum(terms.values()) for terms in self.terms.values()) / max(1, len(self.terms))
+        document_frequency = Counter(term for terms in self.terms.values() for term in terms)
+        self.idf = {term: math.log(1 + (len(self.terms) - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+    
+    def rank(self, question: str, k1: float = 1.2, b: float = 0.75) -> List[Tuple[str, float]]:
+        query_terms = set(tokenize_for_ranking(question))
+        scores = []
+        for table_name, terms in self.terms.items():
+            length_norm = k1 * (1 - b + b * sum(terms.values()) / (self.avg_length or 1))
+            score = sum(self.idf[term] * terms[term] * (k1 + 1) / (terms[term] + length_norm) for term in query_terms if term in terms)
+            scores.append((table_name, score))
+        return sorted(scores, key=lambda x: x[1], reverse=True)
+    
+    def top_tables(self, question: str, n: int = 5) -> List[str]:
+        """The n tables most related to the question, none if no table shares a word with it"""
+        return [table_name for table_name, score in self.rank(question)[:n] if score > 0]
+    
+    def describe(self, table_names: List[str]) -> str:
+        return "\n".join(self.descriptions[table_name] for table_name in table_names)
+
+
+sql_schema_indexes = dict()
+
+def get_sql_schema_index(db_url: URL = None) -> SQLSchemaIndex:
+    """Returns the SQLSchemaIndex of the current CachedSQLDatabase, built again when the schema is refreshed"""
+    db = get_sql_database(db_url)
+    key = str(db_url or get_sql_url())
+    with sql_lock:
+        cached = sql_schema_indexes.get(key)
+    if cached is None or cached[0] is not db:
+        cached = (db, SQLSchemaIndex(db))
+        with sql_lock:
+            sql_schema_indexes[key] = cached
+    return cached[1]
+
+
+def get_sql_toolkit(llm: AzureChatOpenAI, db_url: URL = None) -> SQLDatabaseToolkit:
+    """Returns a SQLDatabaseToolkit reused by all the questions asked with the same llm, until the schema is refreshed"""
+    db = get_sql_database(db_url)
+    with sql_lock:
+        cached = sql_toolkits.get(id(llm))
+        if cached is None or cached[0] is not db or cached[1] is not llm:
+            cached = (db, llm, SQLDatabaseToolkit(db=db, llm=llm))
+            sql_toolkits[id(llm)] = cached
+        return cached[2]
+    
+
 class SQLSearchAgent(BaseTool):
     """Agent to interact with SQL databases"""
     
@@ -676,35 +2469,38 @@ class SQLSearchAgent(BaseTool):
 
     llm: AzureChatOpenAI
     k: int = 30
+    top_n_tables: int = 5 # Tables described in the prompt, chosen by relevance to the question. 0 to let the agent explore them all with the tools
     
-    def _run(self, query: str) -> str:
-        db_config = {
-            'drivername': 'mssql+pyodbc',
-            'username': os.environ["SQL_SERVER_USERNAME"] +'@'+ os.environ["SQL_SERVER_NAME"],
-            'password': os.environ["SQL_SERVER_PASSWORD"],
-            'host': os.environ["SQL_SERVER_NAME"],
-            'port': 1433,
-            'database': os.environ["SQL_SERVER_DATABASE"],
-            'query': {'driver': 'ODBC Driver 17 for SQL Server'}
-        }
-
-        db_url = URL.create(**db_config)
-        db = SQLDatabase.from_uri(db_url)
-        toolkit = SQLDatabaseToolkit(db=db, llm=self.llm)
-        agent_executor = create_sql_agent(
-            prefix=MSSQL_AGENT_PREFIX,
+    def _get_agent_executor(self, query: str = "") -> AgentExecutor:
+        prefix = MSSQL_AGENT_PREFIX
+        toolkit = get_sql_toolkit(self.llm)
+        
+        if self.top_n_tables:
+            schema_index = get_sql_schema_index()
+            table_names = schema_index.top_tables(query, n=self.top_n_tables)
+            if table_names:
+                # Only the prompt is narrowed: the tools still list and describe every table, in case the ranking missed one
+                tables = schema_index.describe(table_names).replace("{", "{{").replace("}", "}}")
+                prefix = MSSQL_AGENT_PREFIX.replace("## Tools:", MSSQL_AGENT_TABLES.format(tables=tables) + "## Tools:")
+            
+        return create_sql_agent(
+            prefix=prefix,
             format_instructions = MSSQL_AGENT_FORMAT_INSTRUCTIONS,
             llm=self.llm,
             toolkit=toolkit,
-            callback_manager=self.callbacks,
             top_k=self.k,
             verbose=self.verbose,
             handle_parsing_errors=True
         )
+    
+    def _run(self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
+        
+        agent_executor = self._get_agent_executor(query)
+        callbacks = get_child_callbacks(self, run_manager)
 
         for i in range(2):
             try:
-                response = agent_executor.run(query) 
+                response = agent_executor.run(query, callbacks=callbacks) 
                 break
             except Exception as e:
                 response = str(e)
@@ -713,9 +2509,23 @@ class SQLSearchAgent(BaseTool):
         return response
         
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("SQLDbTool does not support async")
+        
+        # pyodbc has no async driver: reflecting the schema (when not cached yet) runs in a thread,
+        # the LLM calls of the agent run on the event loop and its SQL tools in the default executor
+        agent_executor = await asyncio.to_thread(self._get_agent_executor, query)
+        callbacks = get_child_callbacks(self, run_manager)
+
+        for i in range(2):
+            try:
+                response = await agent_executor.arun(query, callbacks=callbacks) 
+                break
+            except Exception as e:
+                response = str(e)
+                continue
+
+        return response
         
         
         
@@ -727,26 +2537,50 @@ class ChatGPTTool(BaseTool):
 
     llm: AzureChatOpenAI
     
-    def _run(self, query: str) -> str:
+    def _run(self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         try:
             chatgpt_chain = LLMChain(
                 llm=self.llm, 
                 prompt=CHATGPT_PROMPT,
-                callback_manager=self.callbacks,
                 verbose=self.verbose
             )
 
-            response = chatgpt_chain.run(query)
+            response = chatgpt_chain.run(query, callbacks=get_child_callbacks(self, run_manager))
 
             return response
         except Exception as e:
             print(e)
             
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("ChatGPTTool does not support async")
+        try:
+            chatgpt_chain = LLMChain(
+                llm=self.llm, 
+                prompt=CHATGPT_PROMPT,
+                verbose=self.verbose
+            )
+
+            response = await chatgpt_chain.arun(query, callbacks=get_child_callbacks(self, run_manager))
+
+            return response
+        except Exception as e:
+            print(e)
         
     
+async def abing_search_results(query: str, num_results: int) -> List[Dict]:
+    """Async version of BingSearchAPIWrapper.results"""
+    headers = {"Ocp-Apim-Subscription-Key": os.environ["BING_SUBSCRIPTION_KEY"]}
+    params = {"q": query, "count": num_results, "textDecorations": "true", "textFormat": "HTML"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(os.environ["BING_SEARCH_URL"], headers=headers, params=params) as resp:
+            resp.raise_for_status()
+            search_results = await resp.json()
+    
+    results = search_results["webPages"]["value"]
+    if len(results) == 0:
+        return [{"Result": "No good Bing Search Result was found"}]
+    return [{"snippet": result["snippet"], "title": result["name"], "link": result["url"]} for result in results]
+
     
 class GetBingSearchResults_Tool(BaseTool):
     """Tool for a Bing Search Wrapper"""
@@ -765,7 +2599,10 @@ class GetBingSearchResults_Tool(BaseTool):
     
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchResults does not support async")
+        try:
+            return await abing_search_results(query, num_results=self.k)
+        except:
+            return "No Results Found"
             
 
 class BingSearchAgent(BaseTool):
@@ -777,22 +2614,26 @@ class BingSearchAgent(BaseTool):
     llm: AzureChatOpenAI
     k: int = 5
     
-    def _run(self, tool_input: Union[str, Dict],) -> str:
+    def _get_agent_executor(self) -> AgentExecutor:
+        tools = [GetBingSearchResults_Tool(k=self.k)]
+        
+        return initialize_agent(tools=tools, 
+                                llm=self.llm, 
+                                agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+                                agent_kwargs={'prefix':BING_PROMPT_PREFIX},
+                                verbose=self.verbose,
+                                handle_parsing_errors=True)
+    
+    def _run(self, tool_input: Union[str, Dict], run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         try:
-            tools = [GetBingSearchResults_Tool(k=self.k)]
             parsed_input = self._parse_input(tool_input)
 
-            agent_executor = initialize_agent(tools=tools, 
-                                              llm=self.llm, 
-                                              agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
-                                              agent_kwargs={'prefix':BING_PROMPT_PREFIX},
-                                              callback_manager=self.callbacks,
-                                              verbose=self.verbose,
-                                              handle_parsing_errors=True)
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
             
             for i in range(2):
                 try:
-                    response = run_agent(parsed_input, agent_executor)
+                    response = run_agent(parsed_input, agent_executor, callbacks=callbacks)
                     break
                 except Exception as e:
                     response = str(e)
@@ -803,9 +2644,26 @@ class BingSearchAgent(BaseTool):
         except Exception as e:
             print(e)
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, tool_input: Union[str, Dict], run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchTool does not support async")
+        try:
+            parsed_input = self._parse_input(tool_input)
+
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
+            
+            for i in range(2):
+                try:
+                    response = await arun_agent(parsed_input, agent_executor, callbacks=callbacks)
+                    break
+                except Exception as e:
+                    response = str(e)
+                    continue
+
+            return response
+        
+        except Exception as e:
+            print(e)
         
         
         
@@ -821,15 +2679,18 @@ class GetAPISearchResults_Tool(BaseTool):
     limit_to_domains: list = []
     verbose: bool = False
     
-    def _run(self, query: str) -> str:
-        
-        chain = APIChain.from_llm_and_api_docs(
+    def _get_chain(self) -> APIChain:
+        return APIChain.from_llm_and_api_docs(
                             llm=self.llm,
                             api_docs=self.api_spec,
                             headers=self.headers,
                             verbose=self.verbose,
                             limit_to_domains=self.limit_to_domains
                             )
+    
+    def _run(self, query: str) -> str:
+        
+        chain = self._get_chain()
         try:
             sleep(2) # This is optional to avoid possible TPM rate limits
             response = chain.run(query)
@@ -840,7 +2701,15 @@ class GetAPISearchResults_Tool(BaseTool):
             
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("This Tool does not support async")
+        
+        chain = self._get_chain()
+        try:
+            await asyncio.sleep(2) # This is optional to avoid possible TPM rate limits
+            response = await chain.arun(query)
+        except Exception as e:
+            response = e
+        
+        return response
         
 
 class APISearchAgent(BaseTool):
@@ -856,29 +2725,31 @@ class APISearchAgent(BaseTool):
     limit_to_domains: list = []
     verbose: bool = False
     
-    def _run(self, tool_input: Union[str, Dict],) -> str:
+    def _get_agent_executor(self) -> AgentExecutor:
+        tools = [GetAPISearchResults_Tool(llm=self.llm,
+                                          llm_search=self.llm_search,
+                                          api_spec=str(self.api_spec),
+                                          headers=self.headers,
+                                          verbose=self.verbose,
+                                          limit_to_domains=self.limit_to_domains)]
+        
+        return initialize_agent(tools=tools,
+                                llm=self.llm, 
+                                agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+                                agent_kwargs={'prefix':APISEARCH_PROMPT_PREFIX},
+                                verbose=self.verbose,
+                                handle_parsing_errors=True)
+    
+    def _run(self, tool_input: Union[str, Dict], run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         try:
-            tools = [GetAPISearchResults_Tool(llm=self.llm,
-                                              llm_search=self.llm_search,
-                                              api_spec=str(self.api_spec),
-                                              headers=self.headers,
-                                              verbose=self.verbose,
-                                              limit_to_domains=self.limit_to_domains)]
-            
             parsed_input = self._parse_input(tool_input)
             
-            agent_executor = initialize_agent(tools=tools,
-                                              llm=self.llm, 
-                                              agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-                                              agent_kwargs={'prefix':APISEARCH_PROMPT_PREFIX},
-                                              callback_manager=self.callbacks,
-                                              verbose=self.verbose,
-                                              handle_parsing_errors=True)
-
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
             
             for i in range(2):
                 try:
-                    response = run_agent(parsed_input, agent_executor)
+                    response = run_agent(parsed_input, agent_executor, callbacks=callbacks)
                     break
                 except Exception as e:
                     response = str(e)
@@ -889,7 +2760,24 @@ class APISearchAgent(BaseTool):
         except Exception as e:
             print(e)
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, tool_input: Union[str, Dict], run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("APISearchAgent does not support async")
+        try:
+            parsed_input = self._parse_input(tool_input)
+            
+            agent_executor = self._get_agent_executor()
+            callbacks = get_child_callbacks(self, run_manager)
+            
+            for i in range(2):
+                try:
+                    response = await arun_agent(parsed_input, agent_executor, callbacks=callbacks)
+                    break
+                except Exception as e:
+                    response = str(e)
+                    continue
+
+            return response
+        
+        except Exception as e:
+            print(e)
         
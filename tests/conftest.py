@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the helpers the same way the notebooks do: from common.utils import ...
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,25 @@
+from sqlalchemy import create_engine, text
+
+from common.utils import CachedSQLDatabase
+
+
+def make_db(tmp_path, **kwargs) -> CachedSQLDatabase:
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE notes (id INTEGER, body TEXT)"))
+        connection.execute(text("INSERT INTO notes VALUES (1, :body), (2, 'short')"), {"body": "word " * 50})
+    return CachedSQLDatabase(engine, **kwargs)
+
+
+def test_run_returns_rows_within_budget(tmp_path):
+    db = make_db(tmp_path)
+    assert db.run("SELECT id FROM notes ORDER BY id") == "[(1,), (2,)]"
+    assert db.run("SELECT id FROM notes WHERE id > 2") == ""
+
+
+def test_run_single_oversized_row_is_not_an_empty_result(tmp_path):
+    db = make_db(tmp_path, max_bytes=100)
+    result = db.run("SELECT id, body FROM notes ORDER BY id")
+    assert result != ""
+    assert "first one alone is over the 100 characters budget" in result
+    assert "Columns: id, body" in result
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, List, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.llms.base import LLM
+
+from common.utils import BingSearchAgent, ChatGPTTool
+
+
+class StreamingFakeLLM(LLM):
+    """Fake LLM that streams its answer token by token, like AzureChatOpenAI with streaming=True"""
+    tokens: List[str]
+
+    @property
+    def _llm_type(self) -> str:
+        return "streaming-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        for token in self.tokens:
+            run_manager.on_llm_new_token(token)
+        return "".join(self.tokens)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        for token in self.tokens:
+            await run_manager.on_llm_new_token(token)
+        return "".join(self.tokens)
+
+
+class RecordingHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+        self.tools = []
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.append(token)
+
+    def on_tool_start(self, serialized, input_str: str, **kwargs: Any) -> None:
+        self.tools.append(serialized["name"])
+
+
+def test_chatgpt_tool_streams_to_outer_handler():
+    handler = RecordingHandler()
+    tool = ChatGPTTool.construct(llm=StreamingFakeLLM(tokens=["Hello", " world"]), return_direct=True)
+
+    assert tool.run("hi", callbacks=[handler]) == "Hello world"
+    assert handler.tokens == ["Hello", " world"]
+
+    handler.tokens = []
+    assert asyncio.run(tool.arun("hi", callbacks=[handler])) == "Hello world"
+    assert handler.tokens == ["Hello", " world"]
+
+
+def test_agent_tool_streams_inner_agent_answer_to_outer_handler():
+    handler = RecordingHandler()
+    tokens = ["Thought: I know it\n", "Final Answer:", " Paris"]
+    tool = BingSearchAgent.construct(llm=StreamingFakeLLM(tokens=tokens), k=5, return_direct=True)
+
+    assert asyncio.run(tool.arun("capital of France?", callbacks=[handler])) == "Paris"
+    assert handler.tokens == tokens
+    assert handler.tools == ["@bing"]